@@ -1,17 +1,8 @@
-# Train
-for seed in 22 94 95 96 99 3407
-do
-    for model in lightgbm xgboost catboost tabnet
-    do
-        python src/train.py models=$model models.seed=$seed
-    done
-done
+# Train every model and seed listed in config/orchestrate.yaml from one shared feature matrix
+python src/orchestrate.py
 
-# Inference
+# Inference with the LightGBM diff ensembles the orchestrator wrote to res/orchestrate/lightgbm/<seed>/
 for seed in 22 94 95 96 99 3407
 do
-    for model in lightgbm xgboost catboost tabnet
-    do
-        python src/predict.py models=$model models.seed=$seed
-    done
-done
\ No newline at end of file
+    python src/predict.py models.path=res/orchestrate/lightgbm/$seed/ models.feature_output=matrix models.weight=0
+done
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import json
+import subprocess
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import hydra
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from data import DataStorage
+from features import FeatureEngineer
+from instrumentation import Instrumentation, peak_rss_mb
+from modeling import EnsemblePredictor
+from predict import OnlinePredictor
+from synthetic import LocalEnv, SyntheticData, write_tables
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _bench_data_storage(cfg: DictConfig, instrumentation: Instrumentation) -> DataStorage:
+    for _ in range(cfg.benchmark.repeat):
+        with instrumentation.span("DataStorage.__init__"):
+            data_storage = DataStorage(cfg)
+    return data_storage
+
+
+def _bench_features(cfg: DictConfig, data_storage: DataStorage, instrumentation: Instrumentation) -> None:
+    for _ in range(cfg.benchmark.repeat):
+        feat_gen = FeatureEngineer(
+            data_storage=data_storage, instrumentation=instrumentation, features=cfg.features.select
+        )
+        with instrumentation.span("FeatureEngineer.generate_features"):
+            feat_gen.generate_features(data_storage.df_data)
+
+
+def _bench_iter_test(cfg: DictConfig, tables: dict[str, pl.DataFrame], instrumentation: Instrumentation) -> None:
+    predictor = EnsemblePredictor.load(cfg) if cfg.benchmark.predict else None
+    online_predictor = OnlinePredictor(cfg, DataStorage(cfg), predictor, instrumentation)
+
+    env = LocalEnv(tables, holdout_days=cfg.synthetic.holdout_days)
+    for iteration, (
+        df_test,
+        df_new_target,
+        df_new_client,
+        df_new_historical_weather,
+        df_new_forecast_weather,
+        df_new_electricity_prices,
+        df_new_gas_prices,
+        df_sample_prediction,
+    ) in enumerate(env.iter_test()):
+        predictions = online_predictor.step(
+            df_test,
+            df_new_target,
+            df_new_client,
+            df_new_historical_weather,
+            df_new_forecast_weather,
+            df_new_electricity_prices,
+            df_new_gas_prices,
+        )
+        if predictions is not None:
+            df_sample_prediction["target"] = predictions
+
+        env.predict(df_sample_prediction)
+
+        online_predictor.refresh(iteration)
+
+    online_predictor.close()
+
+
+def _compare(summary: dict[str, dict], previous: dict | None) -> None:
+    previous = previous["results"] if previous is not None else {}
+    print(f"{'name':<64}{'seconds':>12}{'previous':>12}{'change':>10}{'rss MB':>10}")
+    for name, result in summary.items():
+        seconds = result["min_seconds"]
+        line = f"{name:<64}{seconds:>12.4f}"
+        if name in previous:
+            previous_seconds = previous[name]["min_seconds"]
+            line += f"{previous_seconds:>12.4f}{(seconds / previous_seconds - 1) * 100:>9.1f}%"
+        else:
+            line += f"{'-':>12}{'-':>10}"
+        print(line + f"{result['rss_delta_mb']:>10.1f}")
+
+
+def _store(cfg: DictConfig, summary: dict[str, dict]) -> None:
+    path = Path(cfg.benchmark.path) / f"{cfg.benchmark.results}"
+    synthetic = OmegaConf.to_container(cfg.synthetic, resolve=True)
+
+    previous = None
+    if path.exists():
+        for line in path.read_text().splitlines():
+            record = json.loads(line)
+            if record["synthetic"] == synthetic:
+                previous = record
+
+    _compare(summary, previous)
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "synthetic": synthetic,
+        "peak_rss_mb": peak_rss_mb(),
+        "results": summary,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@hydra.main(config_path="../config/", config_name="benchmark")
+def _main(cfg: DictConfig):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        tables = SyntheticData(
+            n_counties=cfg.synthetic.n_counties,
+            n_product_types=cfg.synthetic.n_product_types,
+            n_days=cfg.synthetic.n_days,
+            n_latitudes=cfg.synthetic.n_latitudes,
+            n_longitudes=cfg.synthetic.n_longitudes,
+            seed=cfg.synthetic.seed,
+        ).tables()
+        write_tables(tables, cfg.data.root, holdout_days=cfg.synthetic.holdout_days)
+
+        instrumentation = Instrumentation()
+        data_storage = _bench_data_storage(cfg, instrumentation)
+        _bench_features(cfg, data_storage, instrumentation)
+
+        loop_instrumentation = Instrumentation(bins=cfg.benchmark.bins)
+        _bench_iter_test(cfg, tables, loop_instrumentation)
+        print(loop_instrumentation.histogram())
+
+        summary = instrumentation.summary()
+        summary.update({f"iter_test.{name}": stats for name, stats in loop_instrumentation.summary().items()})
+        _store(cfg, summary)
+
+
+if __name__ == "__main__":
+    _main()
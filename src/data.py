@@ -1,9 +1,11 @@
+import json
+import os
 import warnings
 from pathlib import Path
 
 import pandas as pd
 import polars as pl
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
 warnings.filterwarnings("ignore")
 
@@ -11,34 +13,14 @@ warnings.filterwarnings("ignore")
 class DataStorage:
     def __init__(self, cfg: DictConfig):
         self.cfg = cfg
-        self.df_data = pl.read_csv(
-            Path(self.cfg.data.root) / "train.csv", columns=self.cfg.data.data_cols, try_parse_dates=True
-        )
-        self.df_client = pl.read_csv(
-            Path(self.cfg.data.root) / "client.csv", columns=self.cfg.data.client_cols, try_parse_dates=True
-        )
-        self.df_gas_prices = pl.read_csv(
-            Path(self.cfg.data.root) / "gas_prices.csv", columns=self.cfg.data.gas_prices_cols, try_parse_dates=True
-        )
-        self.df_electricity_prices = pl.read_csv(
-            Path(self.cfg.data.root) / "electricity_prices.csv",
-            columns=self.cfg.data.electricity_prices_cols,
-            try_parse_dates=True,
-        )
-        self.df_forecast_weather = pl.read_csv(
-            Path(self.cfg.data.root) / "forecast_weather.csv",
-            columns=self.cfg.data.forecast_weather_cols,
-            try_parse_dates=True,
-        )
-        self.df_historical_weather = pl.read_csv(
-            Path(self.cfg.data.root) / "historical_weather.csv",
-            columns=self.cfg.data.historical_weather_cols,
-            try_parse_dates=True,
-        )
-        self.df_weather_station_to_county_mapping = pl.read_csv(
-            Path(self.cfg.data.root) / "weather_station_to_county_mapping.csv",
-            columns=self.cfg.data.location_cols,
-            try_parse_dates=True,
+        self.df_data = self._read_table("train.csv", self.cfg.data.data_cols)
+        self.df_client = self._read_table("client.csv", self.cfg.data.client_cols)
+        self.df_gas_prices = self._read_table("gas_prices.csv", self.cfg.data.gas_prices_cols)
+        self.df_electricity_prices = self._read_table("electricity_prices.csv", self.cfg.data.electricity_prices_cols)
+        self.df_forecast_weather = self._read_table("forecast_weather.csv", self.cfg.data.forecast_weather_cols)
+        self.df_historical_weather = self._read_table("historical_weather.csv", self.cfg.data.historical_weather_cols)
+        self.df_weather_station_to_county_mapping = self._read_table(
+            "weather_station_to_county_mapping.csv", self.cfg.data.location_cols
         )
         self.df_data = self.df_data.filter(pl.col("datetime") >= pd.to_datetime("2022-01-01"))
         self.df_target = self.df_data.select(self.cfg.data.target_cols)
@@ -56,52 +38,151 @@ class DataStorage:
             pl.col("longitude").cast(pl.datatypes.Float32),
         )
 
+        self.df_target = self.df_target.sort(self.cfg.data.primary_keys.target[0])
+
+        self.retention_hours = None
+        self.track_updates = False
+        self.updated_datetimes: dict[str, pl.Series] = {}
+
+    def _read_table(self, file_name: str, columns: list[str]) -> pl.DataFrame:
+        path = Path(self.cfg.data.root) / file_name
+        time_col = self.cfg.data.primary_keys[path.stem][0] if path.stem in self.cfg.data.primary_keys else None
+        if not self.cfg.data.cache.enable:
+            return self._sort(self._cast(pl.read_csv(path, columns=columns, try_parse_dates=True)), time_col)
+
+        cache_path = Path(self.cfg.data.cache.path) / f"{path.stem}.arrow"
+        meta_path = cache_path.with_suffix(".json")
+        stat = path.stat()
+        meta = {
+            "source": str(path.resolve()),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "columns": list(columns),
+            "dtypes": OmegaConf.to_container(self.cfg.data.dtypes, resolve=True),
+            "sorted_by": time_col,
+        }
+
+        if cache_path.exists() and meta_path.exists() and json.loads(meta_path.read_text()) == meta:
+            df = pl.read_ipc(cache_path, memory_map=True)
+            return df.with_columns(pl.col(time_col).set_sorted()) if time_col is not None else df
+
+        df = self._sort(self._cast(pl.read_csv(path, columns=columns, try_parse_dates=True)), time_col)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path, tmp_meta_path = cache_path.with_suffix(".arrow.tmp"), meta_path.with_suffix(".json.tmp")
+        df.write_ipc(tmp_path, compression="uncompressed")
+        tmp_meta_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, cache_path)
+        os.replace(tmp_meta_path, meta_path)
+
+        return df
+
+    @staticmethod
+    def _sort(df: pl.DataFrame, time_col: str | None) -> pl.DataFrame:
+        return df.sort(time_col) if time_col is not None else df
+
+    def _cast(self, df: pl.DataFrame) -> pl.DataFrame:
+        dtypes = self.cfg.data.dtypes
+        return df.with_columns(
+            *[pl.col(col).cast(getattr(pl, dtype)) for col, dtype in dtypes.columns.items() if col in df.columns],
+            pl.col(pl.Float64).exclude(list(dtypes.exclude)).cast(getattr(pl, dtypes.floats)),
+        )
+
+    def _append(self, name: str, df_new: pl.DataFrame) -> pl.DataFrame:
+        keys = list(self.cfg.data.primary_keys[name])
+        time_col = keys[0]
+        df = getattr(self, f"df_{name}")
+        df_new = df_new.select(df.columns).unique(keys).sort(time_col)
+
+        if not df_new.is_empty():
+            start = df[time_col].search_sorted(df_new[time_col].head(1), side="left")[0]
+            df_new = df_new.join(df.slice(start).select(keys), on=keys, how="anti")
+
+        if df_new.is_empty():
+            return df
+
+        if df.is_empty() or df_new[time_col][0] >= df[time_col][-1]:
+            df = df.vstack(df_new)
+        else:
+            df = df.merge_sorted(df_new, key=time_col)
+
+        if df.n_chunks() > 64:
+            df = df.rechunk()
+
+        return self._apply_retention(df, time_col)
+
+    def _apply_retention(self, df: pl.DataFrame, time_col: str) -> pl.DataFrame:
+        if self.retention_hours is None or df.is_empty():
+            return df
+
+        cutoff = (
+            df.select(pl.col(time_col).max() - pl.duration(hours=self.retention_hours))
+            .to_series()
+            .cast(df[time_col].dtype)
+        )
+        return df.slice(df[time_col].search_sorted(cutoff, side="left")[0])
+
+    def set_retention(self, hours: int) -> None:
+        self.retention_hours = hours
+        for name in self.cfg.data.primary_keys:
+            time_col = self.cfg.data.primary_keys[name][0]
+            setattr(self, f"df_{name}", self._apply_retention(getattr(self, f"df_{name}"), time_col))
+
+    @staticmethod
+    def _conform(df: pd.DataFrame | pl.DataFrame, columns: list[str], schema: dict) -> pl.DataFrame:
+        if isinstance(df, pd.DataFrame):
+            return pl.from_pandas(df[columns], schema_overrides=schema)
+
+        exprs = []
+        for col in columns:
+            if df.schema[col] == pl.Utf8 and schema[col] == pl.Date:
+                exprs.append(pl.col(col).str.to_datetime().dt.date())
+            elif df.schema[col] == pl.Utf8 and isinstance(schema[col], pl.Datetime):
+                exprs.append(pl.col(col).str.to_datetime().cast(schema[col]))
+            else:
+                exprs.append(pl.col(col).cast(schema[col]))
+        return df.select(exprs)
+
     def update_with_new_data(
         self,
-        df_new_client: pd.DataFrame,
-        df_new_gas_prices: pd.DataFrame,
-        df_new_electricity_prices: pd.DataFrame,
-        df_new_forecast_weather: pd.DataFrame,
-        df_new_historical_weather: pd.DataFrame,
-        df_new_target: pd.DataFrame,
+        df_new_client: pd.DataFrame | pl.DataFrame | None = None,
+        df_new_gas_prices: pd.DataFrame | pl.DataFrame | None = None,
+        df_new_electricity_prices: pd.DataFrame | pl.DataFrame | None = None,
+        df_new_forecast_weather: pd.DataFrame | pl.DataFrame | None = None,
+        df_new_historical_weather: pd.DataFrame | pl.DataFrame | None = None,
+        df_new_target: pd.DataFrame | pl.DataFrame | None = None,
     ) -> None:
-        df_new_client = pl.from_pandas(df_new_client[self.cfg.data.client_cols], schema_overrides=self.schema_client)
-        df_new_gas_prices = pl.from_pandas(
-            df_new_gas_prices[self.cfg.data.gas_prices_cols],
-            schema_overrides=self.schema_gas_prices,
-        )
-        df_new_electricity_prices = pl.from_pandas(
-            df_new_electricity_prices[self.cfg.data.electricity_prices_cols],
-            schema_overrides=self.schema_electricity_prices,
-        )
-        df_new_forecast_weather = pl.from_pandas(
-            df_new_forecast_weather[self.cfg.data.forecast_weather_cols],
-            schema_overrides=self.schema_forecast_weather,
-        )
-        df_new_historical_weather = pl.from_pandas(
-            df_new_historical_weather[self.cfg.data.historical_weather_cols],
-            schema_overrides=self.schema_historical_weather,
-        )
-        df_new_target = pl.from_pandas(df_new_target[self.cfg.data.target_cols], schema_overrides=self.schema_target)
+        df_new_tables = {
+            "client": df_new_client,
+            "gas_prices": df_new_gas_prices,
+            "electricity_prices": df_new_electricity_prices,
+            "forecast_weather": df_new_forecast_weather,
+            "historical_weather": df_new_historical_weather,
+            "target": df_new_target,
+        }
+        df_new_tables = {name: df_new for name, df_new in df_new_tables.items() if df_new is not None}
+        for name, df_new in df_new_tables.items():
+            df_new = self._conform(df_new, self.cfg.data[f"{name}_cols"], getattr(self, f"schema_{name}"))
+            df_new_tables[name] = df_new
+            setattr(self, f"df_{name}", self._append(name, df_new))
 
-        self.df_client = pl.concat([self.df_client, df_new_client]).unique(
-            ["date", "county", "is_business", "product_type"]
-        )
-        self.df_gas_prices = pl.concat([self.df_gas_prices, df_new_gas_prices]).unique(["forecast_date"])
-        self.df_electricity_prices = pl.concat([self.df_electricity_prices, df_new_electricity_prices]).unique(
-            ["forecast_date"]
-        )
-        self.df_forecast_weather = pl.concat([self.df_forecast_weather, df_new_forecast_weather]).unique(
-            ["forecast_datetime", "latitude", "longitude", "hours_ahead"]
-        )
-        self.df_historical_weather = pl.concat([self.df_historical_weather, df_new_historical_weather]).unique(
-            ["datetime", "latitude", "longitude"]
-        )
-        self.df_target = pl.concat([self.df_target, df_new_target]).unique(
-            ["datetime", "county", "is_business", "product_type", "is_consumption"]
-        )
+        if self.track_updates:
+            for name in ["forecast_weather", "historical_weather"]:
+                if name not in df_new_tables:
+                    continue
+                time_col = self.cfg.data.primary_keys[name][0]
+                updated = df_new_tables[name][time_col].unique()
+                if name in self.updated_datetimes:
+                    updated = pl.concat([self.updated_datetimes[name], updated]).unique()
+                self.updated_datetimes[name] = updated
+
+    def pop_updated_datetimes(self) -> dict[str, pl.Series]:
+        updated_datetimes, self.updated_datetimes = self.updated_datetimes, {}
+        return updated_datetimes
 
-    def preprocess_test(self, df_test: pd.DataFrame) -> pl.DataFrame:
-        df_test = df_test.rename(columns={"prediction_datetime": "datetime"})
-        df_test = pl.from_pandas(df_test[self.cfg.data.data_cols[1:]], schema_overrides=self.schema_data)
+    def preprocess_test(self, df_test: pd.DataFrame | pl.DataFrame) -> pl.DataFrame:
+        if isinstance(df_test, pd.DataFrame):
+            df_test = df_test.rename(columns={"prediction_datetime": "datetime"})
+        elif "prediction_datetime" in df_test.columns:
+            df_test = df_test.rename({"prediction_datetime": "datetime"})
+        df_test = self._conform(df_test, self.cfg.data.data_cols[1:], self.schema_data)
         return df_test
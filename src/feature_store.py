@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+import features
+import weather
+from features import FeatureEngineer
+
+
+class FeatureStore:
+    def __init__(self, cfg: DictConfig, feat_gen: FeatureEngineer):
+        self.cfg = cfg
+        self.feat_gen = feat_gen
+        self.data_storage = feat_gen.data_storage
+        self.path = Path(cfg.features.store.path) / self.key
+
+    @property
+    def key(self) -> str:
+        digest = hashlib.sha1()
+        digest.update(json.dumps(OmegaConf.to_container(self.cfg.data, resolve=True), sort_keys=True).encode())
+        digest.update(
+            json.dumps(
+                [
+                    self.feat_gen.client_lag_days,
+                    self.feat_gen.forecast_weather_lags,
+                    self.feat_gen.historical_weather_lags,
+                    self.feat_gen.historical_weather_morning_lags,
+                    self.feat_gen.target_lags,
+                    self.feat_gen.target_sum_lags,
+                    self.feat_gen.features,
+                ]
+            ).encode()
+        )
+        for module in [features, weather]:
+            digest.update(Path(module.__file__).read_bytes())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def _row_hashes(df: pl.DataFrame) -> np.ndarray:
+        return df.hash_rows(seed=0, seed_1=1, seed_2=2, seed_3=3).to_numpy()
+
+    @staticmethod
+    def _window_hash(times: pl.Series, cumulative_hashes: np.ndarray, start: datetime, end: datetime) -> int:
+        lo, hi = times.search_sorted(pl.Series([start, end]).cast(times.dtype), side="left").to_list()
+        if hi <= lo:
+            return 0
+        return int(cumulative_hashes[hi - 1] - (cumulative_hashes[lo - 1] if lo > 0 else np.uint64(0)))
+
+    def month_signatures(self) -> dict[str, str]:
+        df_data = self.data_storage.df_data
+        months = df_data["datetime"].dt.truncate("1mo")
+        data_hashes = self._row_hashes(df_data)
+        mapping_hash = int(
+            self._row_hashes(self.data_storage.df_weather_station_to_county_mapping).sum(dtype=np.uint64)
+        )
+
+        tables = {}
+        for name in self.cfg.data.primary_keys:
+            df = getattr(self.data_storage, f"df_{name}")
+            time_col = self.cfg.data.primary_keys[name][0]
+            tables[name] = (df[time_col], np.cumsum(self._row_hashes(df), dtype=np.uint64))
+
+        lookback = timedelta(hours=self.feat_gen.max_lag_hours)
+        signatures = {}
+        for month_start in months.unique().sort():
+            month_end = pl.Series([month_start]).dt.offset_by("1mo")[0]
+            window = [mapping_hash, int(data_hashes[(months == month_start).to_numpy()].sum(dtype=np.uint64))]
+            for times, cumulative_hashes in tables.values():
+                window.append(self._window_hash(times, cumulative_hashes, month_start - lookback, month_end))
+            signatures[month_start.strftime("%Y-%m")] = hashlib.sha1(json.dumps(window).encode()).hexdigest()
+
+        return signatures
+
+    def _manifest_path(self) -> Path:
+        return self.path / "manifest.json"
+
+    def _partition_path(self, month: str) -> Path:
+        return self.path / f"features_{month}.parquet"
+
+    def update(self) -> list[str]:
+        signatures = self.month_signatures()
+        manifest = json.loads(self._manifest_path().read_text()) if self._manifest_path().exists() else {}
+
+        stale = [
+            month
+            for month, signature in signatures.items()
+            if manifest.get(month) != signature or not self._partition_path(month).exists()
+        ]
+        for month in set(manifest) - set(signatures):
+            self._partition_path(month).unlink(missing_ok=True)
+
+        if stale:
+            df_data = self.data_storage.df_data.filter(pl.col("datetime").dt.strftime("%Y-%m").is_in(stale))
+            df_features = self.feat_gen.generate_features(df_data, output="polars")
+
+            self.path.mkdir(parents=True, exist_ok=True)
+            months = df_data["datetime"].dt.strftime("%Y-%m")
+            for month in stale:
+                tmp_path = self._partition_path(month).with_suffix(".tmp")
+                df_features.filter(months == month).write_parquet(tmp_path)
+                tmp_path.replace(self._partition_path(month))
+
+        self._manifest_path().parent.mkdir(parents=True, exist_ok=True)
+        self._manifest_path().write_text(json.dumps(signatures, indent=2, sort_keys=True))
+
+        return sorted(stale)
+
+    def scan(self) -> pl.LazyFrame:
+        manifest = json.loads(self._manifest_path().read_text())
+        return pl.concat([pl.scan_parquet(self._partition_path(month)) for month in sorted(manifest)])
+
+
+def load_training_features(cfg: DictConfig, feat_gen: FeatureEngineer) -> pl.DataFrame:
+    if cfg.features.store.enable:
+        feature_store = FeatureStore(cfg, feat_gen)
+        feature_store.update()
+        return feature_store.scan().filter(pl.col("target").is_not_null()).collect()
+
+    df_features = feat_gen.generate_features(feat_gen.data_storage.df_data, output="polars")
+    return df_features.filter(pl.col("target").is_not_null())
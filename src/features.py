@@ -1,13 +1,306 @@
+from __future__ import annotations
+
+import json
+from functools import partial
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 import polars as pl
 
 from data import DataStorage
+from instrumentation import Instrumentation
+from weather import WeatherGrid
+
+ROW_STATS = {
+    "mean": np.nanmean,
+    "std": partial(np.nanstd, ddof=1),
+    "min": np.nanmin,
+    "max": np.nanmax,
+    "median": np.nanmedian,
+}
+
+CATEGORICAL_COLS = ["county", "is_business", "product_type", "is_consumption", "segment"]
+
+GENERAL_COLS = [
+    "dayofyear",
+    "hour",
+    "day",
+    "weekday",
+    "month",
+    "year",
+    "segment",
+    "sin(dayofyear)",
+    "cos(dayofyear)",
+    "sin(hour)",
+    "cos(hour)",
+]
+
+REQUIRED_COLS = ["is_consumption", "target_48h"]
+
+TARGET_AGGREGATIONS = {
+    "segment": ("target", ["county", "is_business", "product_type", "is_consumption"]),
+    "county": ("target_all_type_sum", ["county", "is_business", "is_consumption"]),
+    "all": ("target_all_county_type_sum", ["is_business", "is_consumption"]),
+}
+
+TARGET_RATIOS = [
+    ("target", 24 * 7, 24 * 14),
+    ("target", 24 * 2, 24 * 9),
+    ("target", 24 * 3, 24 * 10),
+    ("target", 24 * 2, 24 * 3),
+    ("target_all_type_sum", 24 * 2, 24 * 3),
+    ("target_all_type_sum", 24 * 7, 24 * 14),
+    ("target_all_county_type_sum", 24 * 2, 24 * 3),
+    ("target_all_county_type_sum", 24 * 7, 24 * 14),
+]
+
+
+class CategoryEncoder:
+    def __init__(self, categories: dict[str, list] | None = None):
+        self.categories = categories or {}
+
+    def fit(self, df_features: pl.DataFrame, cat_cols: list[str] | None = None) -> CategoryEncoder:
+        if cat_cols is None:
+            cat_cols = [col for col in CATEGORICAL_COLS if col in df_features.columns]
+        self.categories = {col: df_features[col].drop_nulls().unique().sort().to_list() for col in cat_cols}
+        return self
+
+    def transform(self, values: pl.Series) -> np.ndarray:
+        df_codes = pl.DataFrame(
+            {
+                values.name: pl.Series(self.categories[values.name]).cast(values.dtype),
+                "code": np.arange(len(self.categories[values.name]), dtype=np.float32),
+            }
+        )
+        return values.to_frame().join(df_codes, on=values.name, how="left")["code"].to_numpy()
+
+    def save(self, path: Path) -> None:
+        Path(path).write_text(json.dumps(self.categories))
+
+    @classmethod
+    def load(cls, path: Path) -> CategoryEncoder:
+        return cls(json.loads(Path(path).read_text()))
+
+
+class FeatureNode:
+    def __init__(
+        self,
+        name: str,
+        columns: dict[str, str],
+        source: str | None = None,
+        aggregation: str | None = None,
+        lag: int | None = None,
+        requires: list[str] | None = None,
+    ):
+        self.name = name
+        self.columns = columns
+        self.source = source
+        self.aggregation = aggregation
+        self.lag = lag
+        self.requires = requires or []
+
+
+class FeatureMatrix:
+    def __init__(
+        self,
+        X: np.ndarray,
+        feature_names: list[str],
+        categories: dict[str, list],
+        row_id: np.ndarray,
+        y: np.ndarray | None = None,
+    ):
+        self.X = X
+        self.feature_names = feature_names
+        self.categories = categories
+        self.row_id = row_id
+        self.y = y
+
+    @property
+    def categorical_features(self) -> list[str]:
+        return [col for col in self.feature_names if col in self.categories]
+
+    def __len__(self) -> int:
+        return len(self.X)
+
+    def __getitem__(self, mask: np.ndarray) -> FeatureMatrix:
+        return FeatureMatrix(
+            self.X[mask],
+            feature_names=self.feature_names,
+            categories=self.categories,
+            row_id=self.row_id[mask],
+            y=self.y[mask] if self.y is not None else None,
+        )
+
+    def column(self, name: str) -> np.ndarray:
+        return self.X[:, self.feature_names.index(name)]
+
+    def code(self, name: str, value) -> float:
+        return float(self.categories[name].index(value))
 
 
 class FeatureEngineer:
-    def __init__(self, data_storage: DataStorage):
+    client_lag_days = 2
+    forecast_weather_lags = [0, 7 * 24]
+    historical_weather_lags = [2 * 24, 7 * 24]
+    historical_weather_morning_lags = [1 * 24]
+    target_lags = [
+        2 * 24,
+        3 * 24,
+        4 * 24,
+        5 * 24,
+        6 * 24,
+        7 * 24,
+        8 * 24,
+        9 * 24,
+        10 * 24,
+        11 * 24,
+        12 * 24,
+        13 * 24,
+        14 * 24,
+    ]
+    target_sum_lags = [2 * 24, 3 * 24, 7 * 24, 14 * 24]
+
+    def __init__(
+        self,
+        data_storage: DataStorage,
+        incremental: bool = False,
+        category_encoder: CategoryEncoder | None = None,
+        instrumentation: Instrumentation | None = None,
+        features: list[str] | None = None,
+    ):
         self.data_storage = data_storage
+        self.incremental = incremental
+        self.category_encoder = category_encoder or CategoryEncoder()
+        self.instrumentation = instrumentation
+        self.features = list(features) if features is not None else None
+        self.graph = self._build_graph()
+        self.plan = self._prune(self.features)
+        self._aggregates: dict[str, tuple[pl.DataFrame, ...]] = {}
+        self._updated_datetimes: dict[str, pl.Series] = {}
+        self.weather_grid = WeatherGrid(self.data_storage.df_weather_station_to_county_mapping)
+
+        if self.incremental:
+            self.data_storage.track_updates = True
+
+    @property
+    def max_lag_hours(self) -> int:
+        return max(self.graph[name].lag for name in self.plan if self.graph[name].lag is not None)
+
+    def _weather_nodes(self, columns: set[str]) -> list[FeatureNode]:
+        data_cfg = self.data_storage.cfg.data
+        forecast_cols = [
+            col
+            for col in data_cfg.forecast_weather_cols
+            if col not in ["latitude", "longitude", "hours_ahead", "forecast_datetime"]
+        ]
+        historical_cols = [
+            col for col in data_cfg.historical_weather_cols if col not in ["datetime", "latitude", "longitude"]
+        ]
+
+        joins = []
+        for hours_lag in self.forecast_weather_lags:
+            joins.append(("forecast_weather", "date", hours_lag, forecast_cols, f"_forecast_{hours_lag}h"))
+            joins.append(("forecast_weather", "local", hours_lag, forecast_cols, f"_forecast_local_{hours_lag}h"))
+        for hours_lag in self.historical_weather_lags:
+            joins.append(("historical_weather", "date", hours_lag, historical_cols, f"_historical_{hours_lag}h"))
+            joins.append(("historical_weather", "local", hours_lag, historical_cols, f"_historical_local_{hours_lag}h"))
+        for hours_lag in self.historical_weather_morning_lags:
+            joins.append(("historical_weather", "morning", hours_lag, historical_cols, f"_historical_{hours_lag}h"))
+
+        nodes = []
+        for source, aggregation, hours_lag, value_cols, suffix in joins:
+            names = {col if col not in columns else f"{col}{suffix}": col for col in value_cols}
+            columns.update(names)
+            nodes.append(
+                FeatureNode(
+                    f"{source}_{aggregation}_{hours_lag}h",
+                    names,
+                    source=source,
+                    aggregation=aggregation,
+                    lag=hours_lag,
+                )
+            )
+
+        return nodes
+
+    def _build_graph(self) -> dict[str, FeatureNode]:
+        data_cfg = self.data_storage.cfg.data
+        client_cols = [col for col in data_cfg.client_cols if col not in data_cfg.primary_keys.client]
+
+        nodes = [
+            FeatureNode("general", {col: "datetime" for col in GENERAL_COLS}),
+            FeatureNode(
+                "client",
+                {col: col for col in client_cols},
+                source="client",
+                lag=self.client_lag_days * 24,
+            ),
+        ]
+        columns = {*data_cfg.data_cols, "date", *GENERAL_COLS, *client_cols}
+        nodes.extend(self._weather_nodes(columns))
+
+        target_lags = [("segment", hours_lag) for hours_lag in self.target_lags]
+        target_lags += [
+            (aggregation, hours_lag) for hours_lag in self.target_sum_lags for aggregation in ["county", "all"]
+        ]
+        for aggregation, hours_lag in target_lags:
+            name = f"{TARGET_AGGREGATIONS[aggregation][0]}_{hours_lag}h"
+            nodes.append(FeatureNode(name, {name: "target"}, source="target", aggregation=aggregation, lag=hours_lag))
+
+        for row_stats in data_cfg.row_stats:
+            nodes.append(
+                FeatureNode(
+                    f"{row_stats.name}_row_stats",
+                    {f"{row_stats.name}_{stat}": row_stats.prefix for stat in row_stats.stats},
+                    requires=[f"{row_stats.prefix}_{hours_lag}h" for hours_lag in row_stats.lags],
+                )
+            )
+        for target_prefix, lag_nominator, lag_denomonator in TARGET_RATIOS:
+            name = f"{target_prefix}_ratio_{lag_nominator}_{lag_denomonator}"
+            nodes.append(
+                FeatureNode(
+                    name,
+                    {name: target_prefix},
+                    requires=[f"{target_prefix}_{lag_nominator}h", f"{target_prefix}_{lag_denomonator}h"],
+                )
+            )
+
+        return {node.name: node for node in nodes}
+
+    def _prune(self, features: list[str] | None) -> dict[str, list[str]]:
+        if features is None:
+            return {name: list(node.columns) for name, node in self.graph.items()}
+
+        requested = {*features, *REQUIRED_COLS}
+        plan = {"general": list(GENERAL_COLS)}
+        for name, node in self.graph.items():
+            columns = [col for col in node.columns if col in requested]
+            if columns:
+                plan[name] = columns
+
+        pending = [required for name in plan for required in self.graph[name].requires]
+        while pending:
+            name = pending.pop()
+            plan[name] = list(self.graph[name].columns)
+            pending.extend(self.graph[name].requires)
+
+        return {name: plan[name] for name in self.graph if name in plan}
+
+    def _planned(self, source: str) -> list[FeatureNode]:
+        return [self.graph[name] for name in self.plan if self.graph[name].source == source]
+
+    @property
+    def stages(self) -> list:
+        return [
+            self._add_general_features,
+            self._add_client_features,
+            self._add_forecast_weather_features,
+            self._add_historical_weather_features,
+            self._add_target_features,
+            self._reduce_memory_usage,
+            self._drop_columns,
+        ]
 
     def _add_general_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
         df_features = (
@@ -38,195 +331,233 @@ class FeatureEngineer:
         return df_features
 
     def _add_client_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
+        if "client" not in self.plan:
+            return df_features
+
+        keys = ["county", "is_business", "product_type", "date"]
         df_client = self.data_storage.df_client
+        df_client = df_client.select([col for col in df_client.columns if col in keys or col in self.plan["client"]])
 
         df_features = df_features.join(
-            df_client.with_columns((pl.col("date") + pl.duration(days=2)).cast(pl.Date)),
-            on=["county", "is_business", "product_type", "date"],
+            df_client.with_columns((pl.col("date") + pl.duration(days=self.client_lag_days)).cast(pl.Date)),
+            on=keys,
             how="left",
         )
         return df_features
 
-    def _add_forecast_weather_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
-        df_forecast_weather = self.data_storage.df_forecast_weather
-        df_weather_station_to_county_mapping = self.data_storage.df_weather_station_to_county_mapping
+    def _materialize(self, name: str, datetime_col: str, build) -> tuple[pl.DataFrame, ...]:
+        df_source = getattr(self.data_storage, f"df_{name}")
+        if not self.incremental:
+            return build(df_source)
+
+        updated = self._updated_datetimes.pop(name, None)
+        if name not in self._aggregates:
+            self._aggregates[name] = build(df_source)
+        elif updated is not None:
+            df_fresh = build(df_source.filter(pl.col(datetime_col).is_in(updated)))
+            keep = ~pl.col("datetime").is_in(updated)
+            if self.data_storage.retention_hours is not None:
+                keep = keep & (
+                    pl.col("datetime")
+                    >= pl.col("datetime").max() - pl.duration(hours=self.data_storage.retention_hours)
+                )
+            self._aggregates[name] = tuple(
+                pl.concat([df_agg.filter(keep), df_new]) for df_agg, df_new in zip(self._aggregates[name], df_fresh)
+            )
+
+        return self._aggregates[name]
 
+    def _aggregate_forecast_weather(self, df_forecast_weather: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame]:
         df_forecast_weather = (
             df_forecast_weather.rename({"forecast_datetime": "datetime"})
             .filter((pl.col("hours_ahead") >= 22) & pl.col("hours_ahead") <= 45)
             .drop("hours_ahead")
-            .with_columns(
-                pl.col("latitude").cast(pl.datatypes.Float32),
-                pl.col("longitude").cast(pl.datatypes.Float32),
-            )
-            .join(
-                df_weather_station_to_county_mapping,
-                how="left",
-                on=["longitude", "latitude"],
-            )
-            .drop("longitude", "latitude")
-        )
-
-        df_forecast_weather_date = df_forecast_weather.group_by("datetime").mean().drop("county")
-
-        df_forecast_weather_local = (
-            df_forecast_weather.filter(pl.col("county").is_not_null()).group_by("county", "datetime").mean()
         )
+        return self._to_float32(self.weather_grid.aggregate(df_forecast_weather))
 
-        for hours_lag in [0, 7 * 24]:
-            df_features = df_features.join(
-                df_forecast_weather_date.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)),
-                on="datetime",
-                how="left",
-                suffix=f"_forecast_{hours_lag}h",
-            )
-            df_features = df_features.join(
-                df_forecast_weather_local.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)),
-                on=["county", "datetime"],
-                how="left",
-                suffix=f"_forecast_local_{hours_lag}h",
-            )
+    def _aggregate_historical_weather(self, df_historical_weather: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame]:
+        return self._to_float32(self.weather_grid.aggregate(df_historical_weather))
 
-        return df_features
+    @staticmethod
+    def _to_float32(dfs: tuple[pl.DataFrame, ...]) -> tuple[pl.DataFrame, ...]:
+        return tuple(df.with_columns(pl.col(pl.Float64).cast(pl.Float32)) for df in dfs)
 
-    def _add_historical_weather_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
-        df_historical_weather = self.data_storage.df_historical_weather
-        df_weather_station_to_county_mapping = self.data_storage.df_weather_station_to_county_mapping
+    def _build_target_tensor(self, df_target: pl.DataFrame) -> tuple[pl.DataFrame, np.ndarray, np.ndarray, int]:
+        segment_cols = ["county", "is_business", "product_type", "is_consumption"]
 
-        df_historical_weather = (
-            df_historical_weather.with_columns(
-                pl.col("latitude").cast(pl.datatypes.Float32),
-                pl.col("longitude").cast(pl.datatypes.Float32),
-            )
-            .join(
-                df_weather_station_to_county_mapping,
-                how="left",
-                on=["longitude", "latitude"],
-            )
-            .drop("longitude", "latitude")
+        df_segments = df_target.select(segment_cols).unique(maintain_order=True).with_row_count("index")
+        df_target = df_target.join(df_segments, on=segment_cols, how="left").with_columns(
+            (pl.col("datetime").dt.epoch("s") // 3600).alias("hour_index")
+        )
+        first_hour = df_target["hour_index"].min()
+        n_hours = df_target["hour_index"].max() - first_hour + 1
+
+        segment_index = df_target["index"].to_numpy()
+        hour_index = df_target["hour_index"].to_numpy() - first_hour
+        target = np.full((df_segments.height, n_hours), np.nan)
+        target[segment_index, hour_index] = df_target["target"].cast(pl.Float64).to_numpy()
+        present = np.zeros((df_segments.height, n_hours), dtype=bool)
+        present[segment_index, hour_index] = True
+
+        return df_segments, target, present, first_hour
+
+    def _sum_target_tensor(
+        self, df_segments: pl.DataFrame, target: np.ndarray, present: np.ndarray, group_cols: list[str]
+    ) -> tuple[pl.DataFrame, np.ndarray]:
+        df_groups = df_segments.select(group_cols).unique(maintain_order=True).with_row_count("index")
+        group_index = df_segments.drop("index").join(df_groups, on=group_cols, how="left")["index"].to_numpy()
+
+        target_sum = np.zeros((df_groups.height, target.shape[1]))
+        np.add.at(target_sum, group_index, np.nan_to_num(target))
+        count = np.zeros((df_groups.height, target.shape[1]))
+        np.add.at(count, group_index, present)
+        target_sum[count == 0] = np.nan
+
+        return df_groups, target_sum
+
+    def _gather_lags(
+        self,
+        df_features: pl.DataFrame,
+        df_keys: pl.DataFrame,
+        tensor: np.ndarray,
+        first_hour: int,
+        hours_lags: list[int],
+        name: str,
+    ) -> list[pl.Series]:
+        key_cols = [col for col in df_keys.columns if col != "index"]
+        df_index = df_features.select(*key_cols, (pl.col("datetime").dt.epoch("s") // 3600).alias("hour_index")).join(
+            df_keys, on=key_cols, how="left"
         )
 
-        df_historical_weather_date = df_historical_weather.group_by("datetime").mean().drop("county")
-
-        df_historical_weather_local = (
-            df_historical_weather.filter(pl.col("county").is_not_null()).group_by("county", "datetime").mean()
+        index = df_index["index"].cast(pl.Int64).fill_null(-1).to_numpy()
+        hour_index = df_index["hour_index"].to_numpy() - first_hour
+
+        columns = []
+        for hours_lag in hours_lags:
+            lag_index = hour_index - hours_lag
+            valid = (index >= 0) & (lag_index >= 0) & (lag_index < tensor.shape[1])
+            values = np.full(len(index), np.nan)
+            values[valid] = tensor[index[valid], lag_index[valid]]
+            columns.append(pl.Series(name.format(hours_lag), values, nan_to_null=True))
+
+        return columns
+
+    def _join_weather(self, df_features: pl.DataFrame, df_weather: pl.DataFrame, node: FeatureNode) -> pl.DataFrame:
+        on = ["county", "datetime"] if node.aggregation == "local" else ["datetime"]
+        names = {source: col for col, source in node.columns.items() if col in self.plan[node.name]}
+
+        if node.aggregation == "morning":
+            df_weather = df_weather.filter(pl.col("datetime").dt.hour() <= 10)
+        df_weather = (
+            df_weather.select(*on, *[col for col in df_weather.columns if col in names])
+            .rename(names)
+            .with_columns(pl.col("datetime") + pl.duration(hours=node.lag))
         )
 
-        for hours_lag in [2 * 24, 7 * 24]:
-            df_features = df_features.join(
-                df_historical_weather_date.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)),
-                on="datetime",
-                how="left",
-                suffix=f"_historical_{hours_lag}h",
-            )
-            df_features = df_features.join(
-                df_historical_weather_local.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)),
-                on=["county", "datetime"],
-                how="left",
-                suffix=f"_historical_local_{hours_lag}h",
-            )
+        return df_features.join(df_weather, on=on, how="left")
 
-        for hours_lag in [1 * 24]:
-            df_features = df_features.join(
-                df_historical_weather_date.with_columns(
-                    pl.col("datetime") + pl.duration(hours=hours_lag),
-                    pl.col("datetime").dt.hour().alias("hour"),
-                )
-                .filter(pl.col("hour") <= 10)
-                .drop("hour"),
-                on="datetime",
-                how="left",
-                suffix=f"_historical_{hours_lag}h",
-            )
+    def _add_forecast_weather_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
+        nodes = self._planned("forecast_weather")
+        if not nodes:
+            return df_features
 
-        return df_features
+        df_forecast_weather_date, df_forecast_weather_local = self._materialize(
+            "forecast_weather", "forecast_datetime", self._aggregate_forecast_weather
+        )
+        for node in nodes:
+            df_weather = df_forecast_weather_local if node.aggregation == "local" else df_forecast_weather_date
+            df_features = self._join_weather(df_features, df_weather, node)
 
-    def _add_target_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
-        df_target = self.data_storage.df_target
+        return df_features
 
-        df_target_all_type_sum = (
-            df_target.group_by(["datetime", "county", "is_business", "is_consumption"]).sum().drop("product_type")
-        )
+    def _add_historical_weather_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
+        nodes = self._planned("historical_weather")
+        if not nodes:
+            return df_features
 
-        df_target_all_county_type_sum = (
-            df_target.group_by(["datetime", "is_business", "is_consumption"]).sum().drop("product_type", "county")
+        df_historical_weather_date, df_historical_weather_local = self._materialize(
+            "historical_weather", "datetime", self._aggregate_historical_weather
         )
+        for node in nodes:
+            df_weather = df_historical_weather_local if node.aggregation == "local" else df_historical_weather_date
+            df_features = self._join_weather(df_features, df_weather, node)
 
-        for hours_lag in [
-            2 * 24,
-            3 * 24,
-            4 * 24,
-            5 * 24,
-            6 * 24,
-            7 * 24,
-            8 * 24,
-            9 * 24,
-            10 * 24,
-            11 * 24,
-            12 * 24,
-            13 * 24,
-            14 * 24,
-        ]:
-            df_features = df_features.join(
-                df_target.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)).rename(
-                    {"target": f"target_{hours_lag}h"}
-                ),
-                on=["county", "is_business", "product_type", "is_consumption", "datetime"],
-                how="left",
-            )
+        return df_features
 
-        for hours_lag in [2 * 24, 3 * 24, 7 * 24, 14 * 24]:
-            df_features = df_features.join(
-                df_target_all_type_sum.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)).rename(
-                    {"target": f"target_all_type_sum_{hours_lag}h"}
-                ),
-                on=["county", "is_business", "is_consumption", "datetime"],
-                how="left",
+    def _add_target_features(self, df_features: pl.DataFrame) -> pl.DataFrame:
+        nodes = self._planned("target")
+        if not nodes:
+            return df_features
+
+        df_segments, target, present, first_hour = self._build_target_tensor(self.data_storage.df_target)
+        tensors = {"segment": (df_segments, target)}
+        for aggregation in {node.aggregation for node in nodes} - {"segment"}:
+            tensors[aggregation] = self._sum_target_tensor(
+                df_segments, target, present, TARGET_AGGREGATIONS[aggregation][1]
             )
 
-            df_features = df_features.join(
-                df_target_all_county_type_sum.with_columns(pl.col("datetime") + pl.duration(hours=hours_lag)).rename(
-                    {"target": f"target_all_county_type_sum_{hours_lag}h"}
-                ),
-                on=["is_business", "is_consumption", "datetime"],
-                how="left",
-                suffix=f"_all_county_type_sum_{hours_lag}h",
-            )
+        columns = {}
+        for aggregation, (df_keys, tensor) in tensors.items():
+            hours_lags = [node.lag for node in self._planned("target") if node.aggregation == aggregation]
+            name = TARGET_AGGREGATIONS[aggregation][0] + "_{}h"
+            for column in self._gather_lags(df_features, df_keys, tensor, first_hour, hours_lags, name):
+                columns[column.name] = column
+        df_features = df_features.with_columns([columns[name] for name in self.plan if name in columns])
 
-        cols_for_stats = [f"target_{hours_lag}h" for hours_lag in [2 * 24, 3 * 24, 4 * 24, 5 * 24]]
-        df_features = df_features.with_columns(
-            df_features.select(cols_for_stats).mean(axis=1).alias("target_mean"),
-            df_features.select(cols_for_stats).transpose().std().transpose().to_series().alias("target_std"),
-        )
+        df_features = self._add_row_stats(df_features)
 
-        for target_prefix, lag_nominator, lag_denomonator in [
-            ("target", 24 * 7, 24 * 14),
-            ("target", 24 * 2, 24 * 9),
-            ("target", 24 * 3, 24 * 10),
-            ("target", 24 * 2, 24 * 3),
-            ("target_all_type_sum", 24 * 2, 24 * 3),
-            ("target_all_type_sum", 24 * 7, 24 * 14),
-            ("target_all_county_type_sum", 24 * 2, 24 * 3),
-            ("target_all_county_type_sum", 24 * 7, 24 * 14),
-        ]:
+        for target_prefix, lag_nominator, lag_denomonator in TARGET_RATIOS:
+            name = f"{target_prefix}_ratio_{lag_nominator}_{lag_denomonator}"
+            if name not in self.plan:
+                continue
             df_features = df_features.with_columns(
                 (
                     pl.col(f"{target_prefix}_{lag_nominator}h") / (pl.col(f"{target_prefix}_{lag_denomonator}h") + 1e-3)
-                ).alias(f"{target_prefix}_ratio_{lag_nominator}_{lag_denomonator}")
+                ).alias(name)
             )
 
         return df_features
 
+    def _add_row_stats(self, df_features: pl.DataFrame) -> pl.DataFrame:
+        columns = []
+        for row_stats in self.data_storage.cfg.data.row_stats:
+            stats = [
+                stat
+                for stat in row_stats.stats
+                if f"{row_stats.name}_{stat}" in self.plan.get(f"{row_stats.name}_row_stats", [])
+            ]
+            if not stats:
+                continue
+
+            lags = sorted(row_stats.lags)
+            values = df_features.select([f"{row_stats.prefix}_{hours_lag}h" for hours_lag in lags]).to_numpy()
+
+            for stat in stats:
+                if stat == "ewm":
+                    weights = (1 - row_stats.alpha) ** np.arange(len(lags))
+                    observed = ~np.isnan(values)
+                    result = (np.nan_to_num(values) * weights).sum(axis=1) / (observed * weights).sum(axis=1)
+                else:
+                    result = ROW_STATS[stat](values, axis=1)
+                columns.append(pl.Series(f"{row_stats.name}_{stat}", result, nan_to_null=True))
+
+        return df_features.with_columns(columns)
+
     def _reduce_memory_usage(self, df_features: pl.DataFrame) -> pl.DataFrame:
         df_features = df_features.with_columns(pl.col(pl.Float64).cast(pl.Float32))
         return df_features
 
     def _drop_columns(self, df_features: pl.DataFrame) -> pl.DataFrame:
+        if self.features is not None:
+            return df_features.select(
+                "row_id", *self.features, *[col for col in REQUIRED_COLS if col not in self.features]
+            )
+
         df_features = df_features.drop("date", "datetime", "hour", "dayofyear")
         return df_features
 
-    def _to_pandas(self, df_features: pl.DataFrame, y: pl.Series) -> pd.DataFrame:
-        cat_cols = ["county", "is_business", "product_type", "is_consumption", "segment"]
+    def _to_pandas(self, df_features: pl.DataFrame, y: pl.DataFrame | None) -> pd.DataFrame:
+        cat_cols = [col for col in CATEGORICAL_COLS if col in df_features.columns]
 
         if y is not None:
             df_features = pd.concat([df_features.to_pandas(), y.to_pandas()], axis=1)
@@ -238,7 +569,31 @@ class FeatureEngineer:
 
         return df_features
 
-    def generate_features(self, df_prediction_items: pl.DataFrame) -> pd.DataFrame:
+    def _to_matrix(self, df_features: pl.DataFrame, y: pl.DataFrame | None) -> FeatureMatrix:
+        row_id = df_features["row_id"].to_numpy()
+        df_features = df_features.drop("row_id")
+
+        if not self.category_encoder.categories:
+            raise ValueError("output=matrix requires a fitted CategoryEncoder; fit it on the training features first")
+
+        X = np.empty((df_features.height, df_features.width), dtype=np.float32)
+        for i, col in enumerate(df_features.columns):
+            if col in self.category_encoder.categories:
+                X[:, i] = self.category_encoder.transform(df_features[col])
+            else:
+                X[:, i] = df_features[col].cast(pl.Float32).to_numpy()
+
+        return FeatureMatrix(
+            X,
+            feature_names=df_features.columns,
+            categories=self.category_encoder.categories,
+            row_id=row_id,
+            y=y["target"].to_numpy() if y is not None else None,
+        )
+
+    def generate_features(
+        self, df_prediction_items: pl.DataFrame, output: str = "pandas"
+    ) -> pl.DataFrame | pd.DataFrame | FeatureMatrix:
         if "target" in df_prediction_items.columns:
             df_prediction_items, y = (
                 df_prediction_items.drop("target"),
@@ -247,21 +602,36 @@ class FeatureEngineer:
         else:
             y = None
 
+        if self.incremental:
+            self._updated_datetimes = self.data_storage.pop_updated_datetimes()
+
         df_features = df_prediction_items.with_columns(
             pl.col("datetime").cast(pl.Date).alias("date"),
         )
 
-        for add_features in [
-            self._add_general_features,
-            self._add_client_features,
-            self._add_forecast_weather_features,
-            self._add_historical_weather_features,
-            self._add_target_features,
-            self._reduce_memory_usage,
-            self._drop_columns,
-        ]:
-            df_features = add_features(df_features)
+        for add_features in self.stages:
+            if self.instrumentation is None:
+                df_features = add_features(df_features)
+            else:
+                df_features = self.instrumentation.stage(add_features, df_features)
 
-        df_features = self._to_pandas(df_features, y)
+        if y is not None:
+            df_features = df_features.hstack(y)
 
-        return df_features
+        return self.to_output(df_features, output)
+
+    def to_output(
+        self, df_features: pl.DataFrame, output: str = "pandas"
+    ) -> pl.DataFrame | pd.DataFrame | FeatureMatrix:
+        if output == "polars":
+            return df_features
+
+        if "target" in df_features.columns:
+            df_features, y = df_features.drop("target"), df_features.select("target")
+        else:
+            y = None
+
+        if output == "matrix":
+            return self._to_matrix(df_features, y)
+
+        return self._to_pandas(df_features, y)
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import polars as pl
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _null_rates(df: pl.DataFrame, cols: list[str]) -> dict[str, float]:
+    if not cols or df.is_empty():
+        return {col: 0.0 for col in cols}
+
+    exprs = []
+    for col in cols:
+        missing = pl.col(col).is_null()
+        if df.schema[col] in [pl.Float32, pl.Float64]:
+            missing = missing | pl.col(col).is_nan()
+        exprs.append(missing.mean().alias(col))
+
+    return df.select(exprs).row(0, named=True)
+
+
+class Instrumentation:
+    def __init__(self, path: Path | str | None = None, bins: int = 10, enable: bool = True):
+        self.enable = enable
+        self.path = Path(path) if path is not None else None
+        self.bins = bins
+        self.records: list[dict] = []
+        self.n_iterations = 0
+        self._iteration: dict[str, float] | None = None
+        self._file = None
+
+    def _emit(self, record: dict) -> None:
+        self.records.append(record)
+        if self.path is None:
+            return
+
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def stage(self, add_features: Callable[[pl.DataFrame], pl.DataFrame], df: pl.DataFrame) -> pl.DataFrame:
+        if not self.enable:
+            return add_features(df)
+
+        rss_start, peak_start = rss_mb(), peak_rss_mb()
+        start = time.perf_counter()
+        df_out = add_features(df)
+        seconds = time.perf_counter() - start
+
+        cols = set(df.columns)
+        new_cols = [col for col in df_out.columns if col not in cols]
+        self._emit(
+            {
+                "event": "stage",
+                "name": add_features.__qualname__,
+                "iteration": self.n_iterations if self._iteration is not None else None,
+                "seconds": seconds,
+                "rss_delta_mb": rss_mb() - rss_start,
+                "peak_rss_delta_mb": peak_rss_mb() - peak_start,
+                "rows": df_out.height,
+                "cols": df_out.width,
+                "dropped_cols": len(cols - set(df_out.columns)),
+                "null_rate": _null_rates(df_out, new_cols),
+            }
+        )
+        return df_out
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.enable:
+            yield
+            return
+
+        rss_start, peak_start = rss_mb(), peak_rss_mb()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+
+        if self._iteration is not None:
+            self._iteration[name] = self._iteration.get(name, 0.0) + seconds
+        self._emit(
+            {
+                "event": "span",
+                "name": name,
+                "iteration": self.n_iterations if self._iteration is not None else None,
+                "seconds": seconds,
+                "rss_delta_mb": rss_mb() - rss_start,
+                "peak_rss_delta_mb": peak_rss_mb() - peak_start,
+            }
+        )
+
+    @contextmanager
+    def iteration(self):
+        if not self.enable:
+            yield
+            return
+
+        self._iteration = {}
+        start = time.perf_counter()
+        yield
+        self._emit(
+            {
+                "event": "iteration",
+                "iteration": self.n_iterations,
+                "seconds": time.perf_counter() - start,
+                "latency": self._iteration,
+                "rss_mb": rss_mb(),
+            }
+        )
+        self._iteration = None
+        self.n_iterations += 1
+
+    def summary(self) -> dict[str, dict]:
+        grouped: dict[str, list[dict]] = {}
+        for record in self.records:
+            if record["event"] in ["stage", "span"]:
+                grouped.setdefault(record["name"], []).append(record)
+
+        summary = {}
+        for name, records in grouped.items():
+            seconds = np.array([record["seconds"] for record in records])
+            summary[name] = {
+                "n": len(records),
+                "min_seconds": float(seconds.min()),
+                "mean_seconds": float(seconds.mean()),
+                "p50_seconds": float(np.percentile(seconds, 50)),
+                "p90_seconds": float(np.percentile(seconds, 90)),
+                "max_seconds": float(seconds.max()),
+                "rss_delta_mb": float(max(record["rss_delta_mb"] for record in records)),
+                "peak_rss_delta_mb": float(max(record["peak_rss_delta_mb"] for record in records)),
+            }
+
+        return summary
+
+    def histogram(self, width: int = 40) -> str:
+        lines = []
+        for name, stats in self.summary().items():
+            lines.append(
+                f"{name}  n={stats['n']}  mean={stats['mean_seconds']:.4f}s  p50={stats['p50_seconds']:.4f}s  "
+                f"p90={stats['p90_seconds']:.4f}s  max={stats['max_seconds']:.4f}s"
+            )
+            if stats["n"] < 2:
+                continue
+
+            seconds = [record["seconds"] for record in self.records if record.get("name") == name]
+            counts, edges = np.histogram(seconds, bins=self.bins)
+            for count, low, high in zip(counts, edges[:-1], edges[1:]):
+                bar = "#" * int(np.ceil(count / counts.max() * width)) if count else ""
+                lines.append(f"  {low:>10.4f} - {high:<10.4f} {count:>6} {bar}")
+
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if not self.enable:
+            return
+
+        self._emit({"event": "summary", "n_iterations": self.n_iterations, "stages": self.summary()})
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import hydra
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig
+
+from serve import ARROW_CONTENT_TYPE, JSON_CONTENT_TYPE, read_message, write_message
+
+SEGMENT_COLS = ["county", "is_business", "product_type", "is_consumption"]
+
+
+def _test_rows(cfg: DictConfig) -> pl.DataFrame:
+    df_data = pl.scan_csv(Path(cfg.data.root) / "train.csv", try_parse_dates=True)
+    last_datetime = df_data.select(pl.col("datetime").max()).collect().item()
+    df_segments = df_data.select(SEGMENT_COLS).unique().sort(SEGMENT_COLS).collect()
+
+    datetimes = pl.datetime_range(
+        last_datetime + timedelta(hours=1), last_datetime + timedelta(hours=24), "1h", eager=True
+    ).alias("datetime")
+    return df_segments.join(datetimes.to_frame(), how="cross").with_row_count("row_id")
+
+
+def _payloads(df_rows: pl.DataFrame, n_requests: int, n_rows: int, payload_format: str, seed: int) -> list[bytes]:
+    rng = np.random.default_rng(seed)
+    payloads = []
+    for _ in range(n_requests):
+        df_request = df_rows[rng.choice(df_rows.height, size=min(n_rows, df_rows.height), replace=False)]
+        if payload_format == "arrow":
+            buffer = io.BytesIO()
+            df_request.write_ipc_stream(buffer)
+            payloads.append(buffer.getvalue())
+        else:
+            payloads.append(json.dumps(df_request.to_dict(as_series=False), default=str).encode())
+    return payloads
+
+
+async def _request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str, content_type: str, body: bytes
+) -> tuple[int, bytes]:
+    write_message(writer, f"{method} {path} HTTP/1.1", {"Host": "localhost", "Content-Type": content_type}, body)
+    await writer.drain()
+    start_line, _, body = await read_message(reader)
+    return int(start_line.split(" ", 2)[1]), body
+
+
+async def _worker(cfg: DictConfig, queue: asyncio.Queue, latencies: list[float], errors: list[str]) -> None:
+    content_type = ARROW_CONTENT_TYPE if cfg.loadtest.format == "arrow" else JSON_CONTENT_TYPE
+    reader, writer = await asyncio.open_connection(cfg.loadtest.host, cfg.loadtest.port)
+    try:
+        while not queue.empty():
+            payload = queue.get_nowait()
+            start = time.perf_counter()
+            status, body = await _request(reader, writer, "POST", "/predict", content_type, payload)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(body.decode())
+    finally:
+        writer.close()
+
+
+async def _run(cfg: DictConfig, payloads: list[bytes]) -> None:
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[_worker(cfg, queue, latencies, errors) for _ in range(cfg.loadtest.concurrency)])
+    seconds = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(cfg.loadtest.host, cfg.loadtest.port)
+    _, body = await _request(reader, writer, "GET", "/metrics", JSON_CONTENT_TYPE, b"")
+    writer.close()
+    metrics = json.loads(body)
+
+    latencies = np.array(latencies) * 1000
+    print(f"requests {len(latencies)}  errors {len(errors)}  concurrency {cfg.loadtest.concurrency}")
+    print(f"throughput {len(latencies) / seconds:.1f} req/s  {len(latencies) * cfg.loadtest.rows / seconds:.1f} rows/s")
+    print(
+        f"latency ms  mean {latencies.mean():.2f}  p50 {np.percentile(latencies, 50):.2f}  "
+        f"p90 {np.percentile(latencies, 90):.2f}  p99 {np.percentile(latencies, 99):.2f}  max {latencies.max():.2f}"
+    )
+    for name in ["batch_requests", "batch_rows", "queue_seconds", "features_seconds", "predict_seconds"]:
+        if name in metrics["stats"]:
+            stats = metrics["stats"][name]
+            print(f"server {name:<18} mean {stats['mean']:.4f}  p50 {stats['p50']:.4f}  p90 {stats['p90']:.4f}")
+    if errors:
+        print(f"first error: {errors[0]}")
+
+
+@hydra.main(config_path="../config/", config_name="loadtest")
+def _main(cfg: DictConfig):
+    payloads = _payloads(
+        _test_rows(cfg), cfg.loadtest.requests, cfg.loadtest.rows, cfg.loadtest.format, cfg.loadtest.seed
+    )
+    asyncio.run(_run(cfg, payloads))
+
+
+if __name__ == "__main__":
+    _main()
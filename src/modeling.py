@@ -1,6 +1,174 @@
+from __future__ import annotations
+
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+
+import joblib
+import lightgbm as lgb
+import numpy as np
 import pandas as pd
+from omegaconf import DictConfig
 from sklearn.ensemble import VotingRegressor
 
+from features import FeatureMatrix
+
+
+class BoosterEnsemble:
+    def __init__(self, boosters: list[lgb.Booster]):
+        self.boosters = boosters
+
+    def predict(self, X: pd.DataFrame | FeatureMatrix | np.ndarray) -> np.ndarray:
+        if isinstance(X, FeatureMatrix):
+            X = X.X
+        return np.mean([booster.predict(X) for booster in self.boosters], axis=0)
+
+
+def _boosters(model) -> list[lgb.Booster]:
+    if isinstance(model, BoosterEnsemble):
+        return model.boosters
+    if isinstance(model, VotingRegressor):
+        return [estimator.booster_ for estimator in model.estimators_]
+    if isinstance(model, lgb.LGBMModel):
+        return [model.booster_]
+    return [model]
+
+
+class EnsemblePredictor:
+    def __init__(
+        self,
+        model_consumption,
+        model_consumption_diff,
+        model_production,
+        model_production_diff,
+        weight: float = 0.5,
+    ):
+        self.weight = weight
+        self.boosters = {}
+        for is_consumption, model, model_diff in [
+            (1, model_consumption, model_consumption_diff),
+            (0, model_production, model_production_diff),
+        ]:
+            boosters, boosters_diff = _boosters(model) if model is not None else [], _boosters(model_diff)
+            self.boosters[is_consumption] = [(booster, weight / len(boosters)) for booster in boosters] + [
+                (booster, (1 - weight) / len(boosters_diff)) for booster in boosters_diff
+            ]
+
+        booster = self.boosters[1][0][0]
+        self.feature_names = booster.feature_name()
+        self.pandas_categorical = booster.pandas_categorical
+        for members in self.boosters.values():
+            for booster, _ in members:
+                if booster.feature_name() != self.feature_names:
+                    raise ValueError("boosters must share the same feature layout to be ensembled")
+                if booster.pandas_categorical != self.pandas_categorical:
+                    raise ValueError("boosters must share the same pandas categories to be ensembled")
+
+    @classmethod
+    def load(cls, cfg: DictConfig) -> EnsemblePredictor:
+        weight = cfg.models.get("weight", 0.5)
+        return cls(
+            *[
+                joblib.load(Path(cfg.models.path) / f"{cfg.models[name]}") if weight or name.endswith("_diff") else None
+                for name in ["model_consumption", "model_consumption_diff", "model_production", "model_production_diff"]
+            ],
+            weight=weight,
+        )
+
+    def _to_matrix(self, df_features: pd.DataFrame | FeatureMatrix) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if isinstance(df_features, FeatureMatrix):
+            is_consumption = df_features.column("is_consumption") == df_features.code("is_consumption", 1)
+            X = df_features.X
+            if df_features.feature_names != self.feature_names:
+                X = X[:, [df_features.feature_names.index(col) for col in self.feature_names]]
+            return X, is_consumption, np.nan_to_num(df_features.column("target_48h"))
+
+        X = np.empty((len(df_features), len(self.feature_names)), dtype=np.float32)
+        pandas_categorical = iter(self.pandas_categorical or [])
+        for i, col in enumerate(self.feature_names):
+            values = df_features[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                categories = next(pandas_categorical, None)
+                if categories is None:
+                    raise ValueError("model has no pandas category mapping; predict with feature_output=matrix")
+                codes = values.cat.set_categories(categories).cat.codes.values
+                X[:, i] = np.where(codes >= 0, codes, np.nan)
+            else:
+                X[:, i] = values.values
+
+        is_consumption = (df_features["is_consumption"] == 1).values
+        return X, is_consumption, df_features["target_48h"].fillna(0).values
+
+    def _predict_branch(self, value: int, X: np.ndarray, num_threads: int = 0) -> np.ndarray:
+        boosters, weights = zip(*self.boosters[value])
+        return np.asarray(weights) @ np.stack([booster.predict(X, num_threads=num_threads) for booster in boosters])
+
+    def predict(
+        self, df_features: pd.DataFrame | FeatureMatrix, executor: Executor | None = None, num_threads: int = 0
+    ) -> np.ndarray:
+        X, is_consumption, target_48h = self._to_matrix(df_features)
+
+        predictions = (1 - self.weight) * target_48h.astype(np.float64)
+        masks = {value: is_consumption == bool(value) for value in self.boosters}
+        masks = {value: mask for value, mask in masks.items() if mask.any()}
+
+        if executor is None:
+            for value, mask in masks.items():
+                predictions[mask] += self._predict_branch(value, X[mask], num_threads=num_threads)
+        else:
+            futures = {
+                value: executor.submit(self._predict_branch, value, X[mask], num_threads=num_threads)
+                for value, mask in masks.items()
+            }
+            for value, future in futures.items():
+                predictions[masks[value]] += future.result()
+
+        return np.clip(predictions, 0, np.inf)
+
+    def refresh(
+        self, df_features: pd.DataFrame | FeatureMatrix, params: dict, num_boost_round: int
+    ) -> EnsemblePredictor:
+        if isinstance(df_features, FeatureMatrix):
+            target = df_features.y
+            categorical_features = df_features.categorical_features
+        else:
+            target = df_features["target"].values
+            categorical_features = [
+                col for col in self.feature_names if isinstance(df_features[col].dtype, pd.CategoricalDtype)
+            ]
+        X, is_consumption, target_48h = self._to_matrix(df_features)
+        y = target - (1 - self.weight) * target_48h
+        observed = ~np.isnan(y)
+
+        params = {key: value for key, value in params.items() if key != "n_estimators"}
+        boosters = {}
+        for value, members in self.boosters.items():
+            mask = (is_consumption == bool(value)) & observed
+            if not mask.any():
+                boosters[value] = members
+                continue
+
+            dataset = lgb.Dataset(
+                X[mask],
+                y[mask],
+                init_score=self._predict_branch(value, X[mask]),
+                feature_name=self.feature_names,
+                categorical_feature=categorical_features,
+                free_raw_data=False,
+            )
+            booster = lgb.train({**params, "verbose": -1}, dataset, num_boost_round=num_boost_round)
+            booster.pandas_categorical = self.pandas_categorical
+            boosters[value] = members + [(booster, 1.0)]
+
+        predictor = copy.copy(self)
+        predictor.boosters = boosters
+        return predictor
+
 
 def fit_model(
     train_feats: pd.DataFrame, model_consumption: VotingRegressor, model_production: VotingRegressor
@@ -17,3 +185,145 @@ def fit_model(
     )
 
     return model_consumption, model_production
+
+
+def _dataset_params(params: dict) -> dict:
+    return {key: value for key, value in params.items() if key not in ["n_estimators", "seed", "num_threads"]}
+
+
+def _lgb_dataset(X: pd.DataFrame | FeatureMatrix, y: np.ndarray, params: dict, **kwargs) -> lgb.Dataset:
+    if isinstance(X, FeatureMatrix):
+        return lgb.Dataset(
+            X.X,
+            y,
+            params=params,
+            feature_name=X.feature_names,
+            categorical_feature=X.categorical_features,
+            **kwargs,
+        )
+    return lgb.Dataset(X, y, params=params, **kwargs)
+
+
+def _dataset_path(X: pd.DataFrame | FeatureMatrix, y: np.ndarray, params: dict, path: Path) -> Path:
+    digest = hashlib.sha1()
+    if isinstance(X, FeatureMatrix):
+        digest.update(np.ascontiguousarray(X.X))
+        digest.update(json.dumps([X.feature_names, X.categories, params], sort_keys=True).encode())
+    else:
+        digest.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+        digest.update(json.dumps([list(X.columns), params], sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(y, dtype=np.float64))
+    return Path(path) / f"dataset_{digest.hexdigest()}.bin"
+
+
+def save_dataset(X: pd.DataFrame | FeatureMatrix, y: np.ndarray, params: dict, path: Path) -> Path:
+    params = _dataset_params(params)
+    binary_path = _dataset_path(X, y, params, path)
+    categorical_path = binary_path.with_suffix(".pkl")
+
+    if not (binary_path.exists() and categorical_path.exists()):
+        dataset = _lgb_dataset(X, y, params).construct()
+        binary_path.parent.mkdir(parents=True, exist_ok=True)
+        dataset.save_binary(str(binary_path))
+        joblib.dump(dataset.pandas_categorical, categorical_path)
+
+    return binary_path
+
+
+def load_dataset(binary_path: Path, params: dict) -> lgb.Dataset:
+    dataset = lgb.Dataset(str(binary_path), params=_dataset_params(params)).construct()
+    dataset.pandas_categorical = joblib.load(Path(binary_path).with_suffix(".pkl"))
+    return dataset
+
+
+def build_dataset(
+    X: pd.DataFrame | FeatureMatrix, y: np.ndarray, params: dict, path: Path | None = None
+) -> lgb.Dataset:
+    if path is None:
+        return _lgb_dataset(X, y, _dataset_params(params), free_raw_data=False).construct()
+
+    return load_dataset(save_dataset(X, y, params, path), params)
+
+
+def _train_member(binary_path: Path, params: dict, seed: int, n_jobs: int) -> str:
+    params = {**params, "num_threads": n_jobs}
+    booster = fit_ensemble(load_dataset(binary_path, params), params, [seed]).boosters[0]
+    return booster.model_to_string()
+
+
+def fit_parallel_ensembles(
+    binary_paths: list[Path], params: dict, seeds: list[int], n_workers: int, n_cores: int
+) -> list[BoosterEnsemble]:
+    n_jobs = max(1, n_cores // n_workers)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            [executor.submit(_train_member, binary_path, params, seed, n_jobs) for seed in seeds]
+            for binary_path in binary_paths
+        ]
+
+        ensembles = []
+        for binary_path, members in zip(binary_paths, futures):
+            pandas_categorical = joblib.load(binary_path.with_suffix(".pkl"))
+            boosters = []
+            for future in members:
+                booster = lgb.Booster(model_str=future.result())
+                booster.pandas_categorical = pandas_categorical
+                boosters.append(booster)
+            ensembles.append(BoosterEnsemble(boosters))
+
+    return ensembles
+
+
+def fit_ensemble(dataset: lgb.Dataset, params: dict, seeds: list[int]) -> BoosterEnsemble:
+    params = dict(params)
+    num_boost_round = params.pop("n_estimators")
+
+    boosters = []
+    for seed in seeds:
+        booster = lgb.train({**params, "seed": seed, "verbose": -1}, dataset, num_boost_round=num_boost_round)
+        booster.pandas_categorical = dataset.pandas_categorical
+        boosters.append(booster)
+
+    return BoosterEnsemble(boosters)
+
+
+def split_target(
+    train_feats: pd.DataFrame | FeatureMatrix, is_consumption: int
+) -> tuple[pd.DataFrame | FeatureMatrix, np.ndarray]:
+    if isinstance(train_feats, FeatureMatrix):
+        X = train_feats[train_feats.column("is_consumption") == train_feats.code("is_consumption", is_consumption)]
+        return X, X.y - np.nan_to_num(X.column("target_48h"))
+
+    mask = train_feats["is_consumption"] == is_consumption
+    X = train_feats[mask].drop(columns=["target"])
+    return X, (train_feats[mask]["target"] - train_feats[mask]["target_48h"].fillna(0)).values
+
+
+def fit_shared_model(
+    train_feats: pd.DataFrame | FeatureMatrix,
+    params: dict,
+    seeds: list[int],
+    dataset_path: Path | None = None,
+    n_workers: int = 1,
+    n_cores: int | None = None,
+) -> tuple[BoosterEnsemble]:
+    n_cores = n_cores or os.cpu_count()
+    if n_workers <= 1:
+        params = {**params, "num_threads": n_cores}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        models = []
+        binary_paths = []
+        for is_consumption in [1, 0]:
+            X, y = split_target(train_feats, is_consumption)
+
+            if n_workers <= 1:
+                models.append(fit_ensemble(build_dataset(X, y, params, dataset_path), params, seeds))
+            else:
+                binary_paths.append(save_dataset(X, y, params, dataset_path or Path(tmp_dir)))
+
+        if n_workers > 1:
+            models = fit_parallel_ensembles(binary_paths, params, seeds, n_workers=n_workers, n_cores=n_cores)
+
+    model_consumption, model_production = models
+    return model_consumption, model_production
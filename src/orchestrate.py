@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import hydra
+import joblib
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from data import DataStorage
+from feature_store import load_training_features
+from features import CategoryEncoder, FeatureEngineer, FeatureMatrix
+from modeling import fit_ensemble, load_dataset, save_dataset, split_target
+from validate import make_folds
+
+_SHARED: dict = {}
+
+
+class SharedFeatureMatrix:
+    def __init__(self, matrix: FeatureMatrix, arrays: dict[str, np.ndarray] | None = None):
+        self.buffers = {}
+        self.spec = {
+            "feature_names": matrix.feature_names,
+            "categories": matrix.categories,
+            "arrays": {},
+        }
+        for name, array in [("X", matrix.X), ("y", matrix.y), ("row_id", matrix.row_id), *(arrays or {}).items()]:
+            buffer = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=buffer.buf)[:] = array
+            self.buffers[name] = buffer
+            self.spec["arrays"][name] = (buffer.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(spec: dict) -> tuple[FeatureMatrix, dict[str, np.ndarray], list[shared_memory.SharedMemory]]:
+        buffers, arrays = [], {}
+        for name, (buffer_name, shape, dtype) in spec["arrays"].items():
+            buffer = shared_memory.SharedMemory(name=buffer_name)
+            buffers.append(buffer)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer.buf)
+
+        matrix = FeatureMatrix(
+            arrays.pop("X"),
+            feature_names=spec["feature_names"],
+            categories=spec["categories"],
+            row_id=arrays.pop("row_id"),
+            y=arrays.pop("y"),
+        )
+        return matrix, arrays, buffers
+
+    def close(self) -> None:
+        for buffer in self.buffers.values():
+            buffer.close()
+            buffer.unlink()
+
+
+def _init_worker(spec: dict) -> None:
+    _SHARED["matrix"], _SHARED["arrays"], _SHARED["buffers"] = SharedFeatureMatrix.attach(spec)
+
+
+def _train_lightgbm(model_cfg: dict, seed: int, artifact_dir: Path, n_jobs: int, binary_paths: dict) -> None:
+    params = {**model_cfg["params"], "num_threads": n_jobs}
+    n_seeds = model_cfg.get("n_seeds", 1)
+    seeds = [seed * n_seeds + i for i in range(n_seeds)]
+    for branch, binary_path in binary_paths.items():
+        model = fit_ensemble(load_dataset(binary_path, params), params, seeds)
+        _dump(model, artifact_dir / model_cfg[f"model_{branch}_diff"])
+
+
+def _train_tabnet(model_cfg: dict, seed: int, artifact_dir: Path, n_jobs: int, binary_paths: dict) -> None:
+    import torch
+    from pytorch_tabnet.tab_model import TabNetRegressor
+
+    torch.set_num_threads(n_jobs)
+    params = dict(model_cfg["params"])
+    fit_params = {key: params.pop(key) for key in ["max_epochs", "patience", "batch_size", "virtual_batch_size"]}
+    fit_params["num_workers"] = params.pop("num_workers")
+    lr, step_size, gamma = params.pop("lr"), params.pop("step_size"), params.pop("gamma")
+    params["seed"] = seed
+
+    matrix, train_mask, valid_mask = _SHARED["matrix"], _SHARED["arrays"]["train"], _SHARED["arrays"]["valid"]
+    for branch, is_consumption in [("consumption", 1), ("production", 0)]:
+        mask = matrix.column("is_consumption") == matrix.code("is_consumption", is_consumption)
+        train, valid = train_mask[mask], valid_mask[mask]
+        X, y = split_target(matrix, is_consumption)
+        X, y = np.nan_to_num(X.X), y.reshape(-1, 1)
+
+        model = TabNetRegressor(
+            optimizer_fn=torch.optim.Adam,
+            optimizer_params={"lr": lr},
+            scheduler_fn=torch.optim.lr_scheduler.StepLR,
+            scheduler_params={"step_size": step_size, "gamma": gamma},
+            **params,
+        )
+        model.fit(
+            X[train],
+            y[train],
+            eval_set=[(X[valid], y[valid])],
+            eval_name=list(model_cfg["eval_name"][-1:]),
+            eval_metric=list(model_cfg["eval_metric"]),
+            **fit_params,
+        )
+        model_path = artifact_dir / f"model_{branch}_diff"
+        model.save_model(str(model_path.with_suffix(".tmp")))
+        os.replace(model_path.with_suffix(".tmp.zip"), model_path.with_suffix(".zip"))
+
+
+TRAINERS = {
+    "lightgbm": _train_lightgbm,
+    "tabnet": _train_tabnet,
+}
+
+
+def _dump(model, path: Path) -> None:
+    tmp_path = path.with_suffix(".tmp")
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _artifacts(model_cfg: dict | None, artifact_dir: Path) -> list[Path]:
+    if model_cfg is not None and "model_consumption_diff" in model_cfg:
+        return [artifact_dir / model_cfg["model_consumption_diff"], artifact_dir / model_cfg["model_production_diff"]]
+    return [artifact_dir / "model_consumption_diff.zip", artifact_dir / "model_production_diff.zip"]
+
+
+def _run_job(name: str, model_cfg: dict, seed: int, artifact_dir: Path, n_jobs: int, binary_paths: dict) -> float:
+    start = time.perf_counter()
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        TRAINERS[name](model_cfg, seed, artifact_dir, n_jobs, binary_paths)
+    return time.perf_counter() - start
+
+
+def _load_features(cfg: DictConfig) -> tuple[FeatureMatrix, pl.Series]:
+    data_storage = DataStorage(cfg)
+    feat_gen = FeatureEngineer(data_storage=data_storage)
+
+    df_features = load_training_features(cfg, feat_gen)
+    feat_gen.category_encoder.fit(df_features)
+    matrix = feat_gen.to_output(df_features, output="matrix")
+
+    datetimes = pl.DataFrame({"row_id": matrix.row_id}).join(
+        data_storage.df_data.select("row_id", "datetime"), on="row_id", how="left"
+    )["datetime"]
+    return matrix, datetimes
+
+
+def _model_configs(cfg: DictConfig) -> dict[str, dict | None]:
+    config_dir = Path(__file__).resolve().parents[1] / "config" / "models"
+    model_cfgs = {}
+    for name in cfg.orchestrate.models:
+        model_path = config_dir / f"{name}.yaml"
+        if name == cfg.models.name:
+            model_cfgs[name] = OmegaConf.to_container(cfg.models, resolve=True)
+        elif model_path.exists():
+            model_cfgs[name] = OmegaConf.to_container(OmegaConf.load(model_path), resolve=True)
+        else:
+            model_cfgs[name] = None
+    return model_cfgs
+
+
+def _save_status(path: Path, status: dict) -> None:
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(status, indent=2, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+@hydra.main(config_path="../config/", config_name="orchestrate")
+def _main(cfg: DictConfig):
+    path = Path(cfg.orchestrate.path)
+    path.mkdir(parents=True, exist_ok=True)
+    status_path = path / "status.json"
+    status = json.loads(status_path.read_text()) if cfg.orchestrate.resume and status_path.exists() else {}
+
+    jobs = []
+    model_cfgs = _model_configs(cfg)
+    for name, model_cfg in model_cfgs.items():
+        for seed in cfg.orchestrate.seeds:
+            job = f"{name}/{seed}"
+            artifact_dir = path / name / str(seed)
+            if model_cfg is None or name not in TRAINERS:
+                reason = f"no config at config/models/{name}.yaml" if model_cfg is None else f"no trainer for {name}"
+                status[job] = {"status": "skipped", "reason": reason}
+            elif cfg.orchestrate.resume and all(artifact.exists() for artifact in _artifacts(model_cfg, artifact_dir)):
+                status[job] = {**status.get(job, {}), "status": "done"}
+            else:
+                jobs.append((job, name, model_cfg, seed, artifact_dir))
+    _save_status(status_path, status)
+
+    if jobs:
+        matrix, datetimes = _load_features(cfg)
+        for *_, artifact_dir in jobs:
+            artifact_dir.mkdir(parents=True, exist_ok=True)
+            CategoryEncoder(matrix.categories).save(artifact_dir / f"{cfg.models.categories}")
+
+        dataset_path = Path(cfg.models.dataset_path) if cfg.models.dataset_path else None
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            binary_paths = {}
+            if any(name == "lightgbm" for _, name, *_ in jobs):
+                params = model_cfgs["lightgbm"]["params"]
+                for branch, is_consumption in [("consumption", 1), ("production", 0)]:
+                    X, y = split_target(matrix, is_consumption)
+                    binary_paths[branch] = save_dataset(X, y, params, dataset_path or Path(tmp_dir))
+
+            n_workers = min(cfg.orchestrate.n_workers, len(jobs))
+            n_jobs = max(1, (cfg.orchestrate.n_cores or os.cpu_count()) // n_workers)
+
+            arrays = {}
+            if any(name == "tabnet" for _, name, *_ in jobs):
+                tabnet_cfg = model_cfgs["tabnet"]
+                _, arrays["train"], arrays["valid"] = make_folds(
+                    datetimes, 1, tabnet_cfg["valid_days"], tabnet_cfg["gap_days"]
+                )[0]
+
+            shared = SharedFeatureMatrix(matrix, arrays)
+            del matrix
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(shared.spec,),
+                ) as executor:
+                    futures = {
+                        executor.submit(_run_job, name, model_cfg, seed, artifact_dir, n_jobs, binary_paths): job
+                        for job, name, model_cfg, seed, artifact_dir in jobs
+                    }
+                    for future in as_completed(futures):
+                        job = futures[future]
+                        try:
+                            status[job] = {"status": "done", "seconds": future.result()}
+                        except Exception:
+                            status[job] = {"status": "failed", "error": traceback.format_exc(limit=-3)}
+                        _save_status(status_path, status)
+            finally:
+                shared.close()
+
+    for job, result in sorted(status.items()):
+        message = result.get("error", result.get("reason", "")).strip().splitlines()
+        print(f"{job:<24}{result['status']:<8}{message[-1] if message else ''}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,14 +1,19 @@
+from __future__ import annotations
+
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import hydra
-import joblib
 import numpy as np
 import pandas as pd
+import polars as pl
 from omegaconf import DictConfig
-from sklearn.ensemble import VotingRegressor
 
 from data import DataStorage
-from features import FeatureEngineer
+from features import CategoryEncoder, FeatureEngineer
+from instrumentation import Instrumentation
+from modeling import EnsemblePredictor
 
 try:
     import enefit
@@ -16,31 +21,111 @@ except ModuleNotFoundError:
     pass
 
 
-def predict_model(
-    df_features: pd.DataFrame,
-    model_consumption: VotingRegressor,
-    model_consumption_diff: VotingRegressor,
-    model_production: VotingRegressor,
-    model_production_diff: VotingRegressor,
-) -> np.ndarray:
-    predictions = np.zeros(len(df_features))
-
-    mask = df_features["is_consumption"] == 1
-    predictions[mask.values] = np.clip(
-        model_consumption.predict(df_features[mask]) * 0.5
-        + (df_features[mask]["target_48h"].fillna(0).values + model_consumption_diff.predict(df_features[mask])) * 0.5,
-        0,
-        np.inf,
-    )
-    mask = df_features["is_consumption"] == 0
-    predictions[mask.values] = np.clip(
-        model_production.predict(df_features[mask]) * 0.5
-        + (df_features[mask]["target_48h"].fillna(0).values + model_production_diff.predict(df_features[mask])) * 0.5,
-        0,
-        np.inf,
-    )
-
-    return predictions
+class OnlinePredictor:
+    def __init__(
+        self,
+        cfg: DictConfig,
+        data_storage: DataStorage,
+        predictor: EnsemblePredictor | None,
+        instrumentation: Instrumentation,
+    ):
+        self.cfg = cfg
+        self.data_storage = data_storage
+        self.predictor = predictor
+        self.instrumentation = instrumentation
+
+        category_encoder = None
+        if cfg.models.feature_output == "matrix":
+            category_encoder = CategoryEncoder.load(Path(cfg.models.path) / f"{cfg.models.categories}")
+
+        features = cfg.features.get("select")
+        if predictor is not None and cfg.features.prune:
+            features = predictor.feature_names
+        self.feat_gen = FeatureEngineer(
+            data_storage=data_storage,
+            incremental=cfg.features.incremental,
+            category_encoder=category_encoder,
+            instrumentation=instrumentation,
+            features=features,
+        )
+        if cfg.storage.retention:
+            retention_margin_hours = cfg.storage.retention_margin_hours
+            if cfg.refresh.enable:
+                retention_margin_hours += cfg.refresh.every * 24 + 48
+            data_storage.set_retention(self.feat_gen.max_lag_hours + retention_margin_hours)
+
+        self.refreshed_until = data_storage.df_target["datetime"].max()
+
+        self.executor, self.num_threads = None, 0
+        if cfg.pipeline.enable:
+            n_branches = len(predictor.boosters) if predictor is not None else 1
+            self.executor = ThreadPoolExecutor(max_workers=n_branches)
+            self.num_threads = max(1, (cfg.pipeline.num_threads or os.cpu_count()) // n_branches)
+
+    def step(
+        self,
+        df_test: pd.DataFrame,
+        df_new_target: pd.DataFrame,
+        df_new_client: pd.DataFrame,
+        df_new_historical_weather: pd.DataFrame,
+        df_new_forecast_weather: pd.DataFrame,
+        df_new_electricity_prices: pd.DataFrame,
+        df_new_gas_prices: pd.DataFrame,
+    ) -> np.ndarray | None:
+        with self.instrumentation.iteration():
+            with self.instrumentation.span("update"):
+                if self.executor is not None:
+                    future_test = self.executor.submit(self.data_storage.preprocess_test, df_test)
+                self.data_storage.update_with_new_data(
+                    df_new_client=df_new_client,
+                    df_new_gas_prices=df_new_gas_prices,
+                    df_new_electricity_prices=df_new_electricity_prices,
+                    df_new_forecast_weather=df_new_forecast_weather,
+                    df_new_historical_weather=df_new_historical_weather,
+                    df_new_target=df_new_target,
+                )
+                if self.executor is not None:
+                    df_test = future_test.result()
+                else:
+                    df_test = self.data_storage.preprocess_test(df_test)
+
+            # separately generate test features for both models
+            with self.instrumentation.span("features"):
+                df_test_feats = self.feat_gen.generate_features(df_test, output=self.cfg.models.feature_output)
+
+            if self.predictor is None:
+                return None
+
+            with self.instrumentation.span("predict"):
+                return self.predictor.predict(df_test_feats, executor=self.executor, num_threads=self.num_threads)
+
+    def refresh(self, iteration: int) -> None:
+        if self.predictor is None or not self.cfg.refresh.enable or (iteration + 1) % self.cfg.refresh.every:
+            return
+
+        df_refresh = self.data_storage.df_target.filter(
+            (pl.col("datetime") > self.refreshed_until) & pl.col("target").is_not_null()
+        )
+        if df_refresh.is_empty():
+            return
+
+        with self.instrumentation.span("refresh"):
+            df_refresh_feats = self.feat_gen.generate_features(
+                df_refresh.with_row_count("row_id")
+                .with_columns(pl.col("row_id").cast(self.data_storage.schema_data["row_id"]))
+                .select(self.cfg.data.data_cols),
+                output=self.cfg.models.feature_output,
+            )
+            self.predictor = self.predictor.refresh(
+                df_refresh_feats,
+                params={**self.cfg.models.params, "learning_rate": self.cfg.refresh.learning_rate},
+                num_boost_round=self.cfg.refresh.num_boost_round,
+            )
+        self.refreshed_until = df_refresh["datetime"].max()
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
 
 
 @hydra.main(config_path="../config/", config_name="predict")
@@ -48,17 +133,10 @@ def _main(cfg: DictConfig):
     env = enefit.make_env()
     iter_test = env.iter_test()
 
-    data_storage = DataStorage(cfg)
-    feat_gen = FeatureEngineer(data_storage=data_storage)
-    # df_train = feat_gen.generate_features(data_storage.df_data)
-    # df_train = df_train[df_train["target"].notnull()]
-
-    model_consumption = joblib.load(Path(cfg.models.path) / f"{cfg.models.model_consumption}")
-    model_production = joblib.load(Path(cfg.models.path) / f"{cfg.models.model_production}")
-    model_consumption_diff = joblib.load(Path(cfg.models.path) / f"{cfg.models.model_consumption_diff}")
-    model_production_diff = joblib.load(Path(cfg.models.path) / f"{cfg.models.model_production_diff}")
+    instrumentation = Instrumentation(path=cfg.instrumentation.path, enable=cfg.instrumentation.enable)
+    online_predictor = OnlinePredictor(cfg, DataStorage(cfg), EnsemblePredictor.load(cfg), instrumentation)
 
-    for (
+    for iteration, (
         df_test,
         df_new_target,
         df_new_client,
@@ -67,27 +145,26 @@ def _main(cfg: DictConfig):
         df_new_electricity_prices,
         df_new_gas_prices,
         df_sample_prediction,
-    ) in iter_test:
-        data_storage.update_with_new_data(
-            df_new_client=df_new_client,
-            df_new_gas_prices=df_new_gas_prices,
-            df_new_electricity_prices=df_new_electricity_prices,
-            df_new_forecast_weather=df_new_forecast_weather,
-            df_new_historical_weather=df_new_historical_weather,
-            df_new_target=df_new_target,
+    ) in enumerate(iter_test):
+        df_sample_prediction["target"] = online_predictor.step(
+            df_test,
+            df_new_target,
+            df_new_client,
+            df_new_historical_weather,
+            df_new_forecast_weather,
+            df_new_electricity_prices,
+            df_new_gas_prices,
         )
 
-        # separately generate test features for both models
-        df_test = data_storage.preprocess_test(df_test)
-        df_test_feats = feat_gen.generate_features(df_test)
+        env.predict(df_sample_prediction)
 
-        preds = predict_model(
-            df_test_feats, model_consumption, model_consumption_diff, model_production, model_production_diff
-        )
+        online_predictor.refresh(iteration)
 
-        df_sample_prediction["target"] = preds
+    online_predictor.close()
 
-        env.predict(df_sample_prediction)
+    if instrumentation.enable:
+        instrumentation.close()
+        print(instrumentation.histogram())
 
 
 if __name__ == "__main__":
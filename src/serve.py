@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import hydra
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig
+
+from data import DataStorage
+from features import CategoryEncoder, FeatureEngineer
+from modeling import EnsemblePredictor
+
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+JSON_CONTENT_TYPE = "application/json"
+TABLES = ["client", "gas_prices", "electricity_prices", "forecast_weather", "historical_weather", "target"]
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+BAD_REQUEST_ERRORS = (
+    ValueError,
+    KeyError,
+    pl.ColumnNotFoundError,
+    pl.ComputeError,
+    pl.InvalidOperationError,
+    pl.SchemaError,
+)
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[str, dict[str, str], bytes] | None:
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b"\r\n", b"\n", b""]:
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return start_line.decode("latin-1").strip(), headers, body
+
+
+def write_message(writer: asyncio.StreamWriter, start_line: str, headers: dict[str, str], body: bytes) -> None:
+    headers = {**headers, "Content-Length": str(len(body))}
+    head = start_line + "\r\n" + "".join(f"{key}: {value}\r\n" for key, value in headers.items()) + "\r\n"
+    writer.write(head.encode("latin-1") + body)
+
+
+def decode_frame(body: bytes, content_type: str) -> pl.DataFrame:
+    if content_type.startswith(ARROW_CONTENT_TYPE):
+        return pl.read_ipc_stream(io.BytesIO(body))
+    return pl.DataFrame(json.loads(body))
+
+
+def encode_frame(df: pl.DataFrame, content_type: str) -> bytes:
+    if content_type.startswith(ARROW_CONTENT_TYPE):
+        buffer = io.BytesIO()
+        df.write_ipc_stream(buffer)
+        return buffer.getvalue()
+    return json.dumps(df.to_dict(as_series=False), default=str).encode()
+
+
+class ServiceMetrics:
+    def __init__(self, window: int = 10000):
+        self.started = time.perf_counter()
+        self.counts: dict[str, int] = {}
+        self.values: dict[str, deque] = {}
+        self.window = window
+        self.completed: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self.values.setdefault(name, deque(maxlen=self.window)).append(value)
+
+    def batch(self, n_requests: int, n_rows: int) -> None:
+        self.count("batches")
+        self.count("predicted_rows", n_rows)
+        self.observe("batch_requests", n_requests)
+        self.observe("batch_rows", n_rows)
+        with self._lock:
+            self.completed.append((time.perf_counter(), n_requests, n_rows))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+            values = {name: np.array(values) for name, values in self.values.items()}
+            completed = list(self.completed)
+
+        now = time.perf_counter()
+        recent = [(requests, rows) for timestamp, requests, rows in completed if now - timestamp <= 60]
+        uptime = now - self.started
+
+        stats = {}
+        for name, values in values.items():
+            stats[name] = {
+                "n": len(values),
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p90": float(np.percentile(values, 90)),
+                "p99": float(np.percentile(values, 99)),
+                "max": float(values.max()),
+            }
+
+        return {
+            "uptime_seconds": uptime,
+            "counts": counts,
+            "throughput": {
+                "requests_per_second": counts.get("predict_requests", 0) / uptime,
+                "rows_per_second": counts.get("predicted_rows", 0) / uptime,
+                "recent_requests_per_second": sum(requests for requests, _ in recent) / min(uptime, 60),
+                "recent_rows_per_second": sum(rows for _, rows in recent) / min(uptime, 60),
+            },
+            "stats": stats,
+        }
+
+
+class PredictionService:
+    def __init__(self, cfg: DictConfig):
+        self.cfg = cfg
+        self.data_storage = DataStorage(cfg)
+        category_encoder = None
+        if cfg.models.feature_output == "matrix":
+            category_encoder = CategoryEncoder.load(Path(cfg.models.path) / f"{cfg.models.categories}")
+
+        self.predictor = EnsemblePredictor.load(cfg)
+        self.feat_gen = FeatureEngineer(
+            data_storage=self.data_storage,
+            incremental=cfg.features.incremental,
+            category_encoder=category_encoder,
+            features=self.predictor.feature_names if cfg.features.prune else None,
+        )
+        if cfg.storage.retention:
+            self.data_storage.set_retention(self.feat_gen.max_lag_hours + cfg.storage.retention_margin_hours)
+
+        self.state_executor = ThreadPoolExecutor(max_workers=1)
+        self.score_executor = ThreadPoolExecutor(max_workers=len(self.predictor.boosters))
+        self.num_threads = max(1, (cfg.pipeline.num_threads or os.cpu_count()) // len(self.predictor.boosters))
+        self.metrics = ServiceMetrics(cfg.serve.metrics_window)
+        self.queue: asyncio.Queue | None = None
+
+    def _update(self, tables: dict[str, pl.DataFrame]) -> None:
+        start = time.perf_counter()
+        self.data_storage.update_with_new_data(**{f"df_new_{name}": df for name, df in tables.items()})
+        self.metrics.observe("update_seconds", time.perf_counter() - start)
+
+    def _predict_batch(self, df_test: pl.DataFrame) -> np.ndarray:
+        start = time.perf_counter()
+        df_test_feats = self.feat_gen.generate_features(df_test, output=self.cfg.models.feature_output)
+        self.metrics.observe("features_seconds", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        predictions = self.predictor.predict(df_test_feats, executor=self.score_executor, num_threads=self.num_threads)
+        self.metrics.observe("predict_seconds", time.perf_counter() - start)
+        return predictions
+
+    async def update(self, tables: dict[str, pl.DataFrame]) -> None:
+        unknown = set(tables) - set(TABLES)
+        if unknown:
+            raise HTTPError(400, f"unknown tables: {sorted(unknown)}")
+        await asyncio.get_running_loop().run_in_executor(self.state_executor, self._update, tables)
+
+    async def predict(self, df_test: pl.DataFrame) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((df_test, future, time.perf_counter()))
+        return await future
+
+    async def _next_batch(self) -> list[tuple]:
+        batch = [await self.queue.get()]
+        n_rows = batch[0][0].height
+        if self.queue.empty() and n_rows < self.cfg.serve.max_batch_rows:
+            await asyncio.sleep(self.cfg.serve.max_wait_ms / 1000)
+
+        while n_rows < self.cfg.serve.max_batch_rows and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+            n_rows += batch[-1][0].height
+
+        return batch
+
+    async def run_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            start = time.perf_counter()
+            for _, _, queued in batch:
+                self.metrics.observe("queue_seconds", start - queued)
+
+            offsets = np.cumsum([0] + [df.height for df, _, _ in batch])
+            df_batch = pl.concat([df for df, _, _ in batch]).with_columns(
+                pl.Series("row_id", np.arange(offsets[-1])).cast(self.data_storage.schema_data["row_id"])
+            )
+            try:
+                predictions = await loop.run_in_executor(self.state_executor, self._predict_batch, df_batch)
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            self.metrics.batch(len(batch), df_batch.height)
+            for (_, future, _), lo, hi in zip(batch, offsets[:-1], offsets[1:]):
+                if not future.done():
+                    future.set_result(predictions[lo:hi])
+
+    async def _route(self, method: str, path: str, headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+        content_type = headers.get("content-type", JSON_CONTENT_TYPE)
+
+        if method == "GET" and path == "/health":
+            return 200, JSON_CONTENT_TYPE, json.dumps({"status": "ok"}).encode()
+
+        if method == "GET" and path == "/metrics":
+            return 200, JSON_CONTENT_TYPE, json.dumps(self.metrics.snapshot()).encode()
+
+        if method == "POST" and path == "/predict":
+            df_test = decode_frame(body, content_type)
+            if "row_id" not in df_test.columns:
+                df_test = df_test.with_row_count("row_id")
+            df_test = self.data_storage.preprocess_test(df_test)
+
+            predictions = await self.predict(df_test)
+            df_predictions = pl.DataFrame([df_test["row_id"], pl.Series("target", predictions)])
+            return 200, content_type, encode_frame(df_predictions, content_type)
+
+        if method == "POST" and path == "/update":
+            if content_type.startswith(ARROW_CONTENT_TYPE):
+                raise HTTPError(400, "Arrow updates are sent per table to /update/<table>")
+            tables = {name: pl.DataFrame(records) for name, records in json.loads(body).items()}
+            await self.update(tables)
+            return 200, JSON_CONTENT_TYPE, json.dumps({name: df.height for name, df in tables.items()}).encode()
+
+        if method == "POST" and path.startswith("/update/"):
+            name = path.removeprefix("/update/")
+            df_new = decode_frame(body, content_type)
+            await self.update({name: df_new})
+            return 200, JSON_CONTENT_TYPE, json.dumps({name: df_new.height}).encode()
+
+        raise HTTPError(404, f"no route for {method} {path}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if message is None:
+                    break
+
+                start_line, headers, body = message
+                try:
+                    method, path, _ = start_line.split(" ", 2)
+                except ValueError:
+                    break
+                route = path.split("?", 1)[0]
+                name = route.strip("/").split("/", 1)[0] or "root"
+                start = time.perf_counter()
+                try:
+                    status, content_type, payload = await self._route(method, route, headers, body)
+                except HTTPError as error:
+                    status, payload = error.status, json.dumps({"error": str(error)}).encode()
+                    content_type = JSON_CONTENT_TYPE
+                except Exception as error:
+                    status = 400 if isinstance(error, BAD_REQUEST_ERRORS) else 500
+                    payload = json.dumps({"error": f"{type(error).__name__}: {error}"}).encode()
+                    content_type = JSON_CONTENT_TYPE
+
+                self.metrics.count(f"{name}_requests")
+                if status != 200:
+                    self.metrics.count(f"{name}_errors")
+                self.metrics.observe(f"{name}_latency_seconds", time.perf_counter() - start)
+
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                write_message(
+                    writer,
+                    f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                    {"Content-Type": content_type, "Connection": "keep-alive" if keep_alive else "close"},
+                    payload,
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self.queue = asyncio.Queue()
+        batches = asyncio.create_task(self.run_batches())
+        server = await asyncio.start_server(self.handle, self.cfg.serve.host, self.cfg.serve.port)
+        print(f"serving on http://{self.cfg.serve.host}:{self.cfg.serve.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+            self.state_executor.shutdown()
+            self.score_executor.shutdown()
+
+
+@hydra.main(config_path="../config/", config_name="serve")
+def _main(cfg: DictConfig):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        service = PredictionService(cfg)
+        asyncio.run(service.serve())
+
+
+if __name__ == "__main__":
+    _main()
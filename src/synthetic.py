@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+FORECAST_WEATHER_COLS = [
+    "latitude",
+    "longitude",
+    "origin_datetime",
+    "hours_ahead",
+    "temperature",
+    "dewpoint",
+    "cloudcover_high",
+    "cloudcover_low",
+    "cloudcover_mid",
+    "cloudcover_total",
+    "10_metre_u_wind_component",
+    "10_metre_v_wind_component",
+    "data_block_id",
+    "forecast_datetime",
+    "direct_solar_radiation",
+    "surface_solar_radiation_downwards",
+    "snowfall",
+    "total_precipitation",
+]
+HISTORICAL_WEATHER_COLS = [
+    "datetime",
+    "temperature",
+    "dewpoint",
+    "rain",
+    "snowfall",
+    "surface_pressure",
+    "cloudcover_total",
+    "cloudcover_low",
+    "cloudcover_mid",
+    "cloudcover_high",
+    "windspeed_10m",
+    "winddirection_10m",
+    "shortwave_radiation",
+    "direct_solar_radiation",
+    "diffuse_radiation",
+    "latitude",
+    "longitude",
+    "data_block_id",
+]
+
+
+class SyntheticData:
+    def __init__(
+        self,
+        n_counties: int = 16,
+        n_product_types: int = 4,
+        n_days: int = 120,
+        n_latitudes: int = 8,
+        n_longitudes: int = 14,
+        start: date = date(2022, 1, 1),
+        seed: int = 42,
+    ):
+        self.n_counties = n_counties
+        self.n_product_types = n_product_types
+        self.n_days = n_days
+        self.n_latitudes = n_latitudes
+        self.n_longitudes = n_longitudes
+        self.start = datetime.combine(start, datetime.min.time())
+        self.rng = np.random.default_rng(seed)
+
+        self.hours = pl.datetime_range(
+            self.start, self.start + timedelta(days=n_days, hours=-1), "1h", time_unit="us", eager=True
+        )
+        self.dates = pl.date_range(start, start + timedelta(days=n_days - 1), "1d", eager=True)
+        self.df_segments = self._segments()
+        self.df_stations = self._stations()
+
+    def _segments(self) -> pl.DataFrame:
+        county, is_business, product_type = np.meshgrid(
+            np.arange(self.n_counties), [0, 1], np.arange(self.n_product_types), indexing="ij"
+        )
+        return pl.DataFrame(
+            {
+                "county": county.ravel(),
+                "is_business": is_business.ravel(),
+                "product_type": product_type.ravel(),
+            }
+        ).with_row_count("prediction_unit_id")
+
+    def _stations(self) -> pl.DataFrame:
+        latitude, longitude = np.meshgrid(
+            57.6 + 0.5 * np.arange(self.n_latitudes), 21.7 + 0.5 * np.arange(self.n_longitudes), indexing="ij"
+        )
+        n_stations = latitude.size
+        county = self.rng.integers(0, self.n_counties, n_stations).astype(float)
+        county[self.rng.random(n_stations) < 0.2] = np.nan
+        county[: self.n_counties] = np.arange(min(self.n_counties, n_stations))
+        return pl.DataFrame(
+            {
+                "latitude": latitude.ravel().round(1),
+                "longitude": longitude.ravel().round(1),
+                "county": pl.Series(county, nan_to_null=True).cast(pl.Int64),
+            }
+        )
+
+    def _data_block_id(self, col: str, days: int = 0) -> pl.Expr:
+        return ((pl.col(col).cast(pl.Date) - pl.lit(self.start.date())).dt.days() + days).alias("data_block_id")
+
+    def train(self) -> pl.DataFrame:
+        n_hours, n_segments = len(self.hours), self.df_segments.height
+        hour_of_day = self.hours.dt.hour().to_numpy()
+        daylight = np.clip(np.sin((hour_of_day - 6) / 12 * np.pi), 0, None)
+        capacity = self.rng.gamma(2.0, 200.0, n_segments)
+
+        df = self.df_segments.join(pl.DataFrame({"is_consumption": [0, 1]}), how="cross").join(
+            pl.DataFrame({"datetime": self.hours}), how="cross"
+        )
+        scale = np.repeat(capacity, 2 * n_hours)
+        profile = np.tile(np.r_[daylight, 0.5 + 0.3 * np.cos(hour_of_day / 24 * 2 * np.pi)], n_segments)
+        target = scale * profile * self.rng.gamma(4.0, 0.25, df.height)
+        target[self.rng.random(df.height) < 0.001] = np.nan
+
+        return (
+            df.with_columns(pl.Series("target", target, nan_to_null=True))
+            .sort("datetime", "county", "is_business", "product_type", "is_consumption")
+            .with_row_count("row_id")
+            .with_columns(self._data_block_id("datetime"))
+            .select(
+                "county",
+                "is_business",
+                "product_type",
+                "target",
+                "is_consumption",
+                "datetime",
+                "data_block_id",
+                "row_id",
+                "prediction_unit_id",
+            )
+        )
+
+    def client(self) -> pl.DataFrame:
+        df = self.df_segments.join(pl.DataFrame({"date": self.dates}), how="cross")
+        eic_count = self.rng.integers(1, 500, self.df_segments.height)
+        capacity = self.rng.gamma(2.0, 500.0, self.df_segments.height)
+        growth = 1 + 0.002 * np.arange(len(self.dates))
+        return df.with_columns(
+            pl.Series("eic_count", np.repeat(eic_count, len(self.dates))),
+            pl.Series("installed_capacity", np.outer(capacity, growth).ravel().round(2)),
+            self._data_block_id("date", 2),
+        ).select("product_type", "county", "eic_count", "installed_capacity", "is_business", "date", "data_block_id")
+
+    def gas_prices(self) -> pl.DataFrame:
+        lowest = 40 + np.cumsum(self.rng.normal(0, 2, len(self.dates)))
+        return pl.DataFrame(
+            {
+                "forecast_date": self.dates,
+                "lowest_price_per_mwh": lowest.round(2),
+                "highest_price_per_mwh": (lowest + self.rng.gamma(2.0, 3.0, len(self.dates))).round(2),
+            }
+        ).with_columns(
+            (pl.col("forecast_date") - pl.duration(days=1)).alias("origin_date"),
+            self._data_block_id("forecast_date", 1),
+        )
+
+    def electricity_prices(self) -> pl.DataFrame:
+        return pl.DataFrame(
+            {
+                "forecast_date": self.hours,
+                "euros_per_mwh": self.rng.gamma(2.0, 50.0, len(self.hours)).round(2),
+            }
+        ).with_columns(
+            (pl.col("forecast_date") - pl.duration(days=1)).alias("origin_date"),
+            self._data_block_id("forecast_date", 1),
+        )
+
+    def _weather_values(self, cols: list[str], n_rows: int) -> dict[str, np.ndarray]:
+        values = {col: self.rng.normal(0, 1, n_rows).astype(np.float32) for col in cols}
+        for col in cols:
+            if col.startswith("cloudcover"):
+                values[col] = self.rng.random(n_rows).astype(np.float32)
+            elif "radiation" in col or col in ["rain", "snowfall", "total_precipitation"]:
+                values[col] = self.rng.gamma(0.5, 50.0, n_rows).astype(np.float32)
+        return values
+
+    def forecast_weather(self) -> pl.DataFrame:
+        n_stations = self.df_stations.height
+        origins = pl.datetime_range(
+            self.start - timedelta(days=1),
+            self.start + timedelta(days=self.n_days - 1),
+            "1d",
+            time_unit="us",
+            eager=True,
+        )
+        n_rows = len(origins) * 48 * n_stations
+        value_cols = [col for col in FORECAST_WEATHER_COLS[4:] if col not in ["data_block_id", "forecast_datetime"]]
+
+        return (
+            pl.DataFrame(
+                {
+                    "latitude": np.tile(self.df_stations["latitude"].to_numpy(), len(origins) * 48),
+                    "longitude": np.tile(self.df_stations["longitude"].to_numpy(), len(origins) * 48),
+                    "origin_datetime": np.repeat(origins.to_numpy(), 48 * n_stations),
+                    "hours_ahead": np.tile(np.repeat(np.arange(1, 49), n_stations), len(origins)),
+                    **self._weather_values(value_cols, n_rows),
+                }
+            )
+            .with_columns(
+                (pl.col("origin_datetime") + pl.duration(hours=pl.col("hours_ahead"))).alias("forecast_datetime"),
+                self._data_block_id("origin_datetime", 1),
+            )
+            .select(FORECAST_WEATHER_COLS)
+        )
+
+    def historical_weather(self) -> pl.DataFrame:
+        n_stations = self.df_stations.height
+        hours = pl.datetime_range(
+            self.start - timedelta(days=2),
+            self.start + timedelta(days=self.n_days - 1),
+            "1h",
+            time_unit="us",
+            eager=True,
+        )
+        value_cols = HISTORICAL_WEATHER_COLS[1:-3]
+
+        return (
+            pl.DataFrame(
+                {
+                    "datetime": np.repeat(hours.to_numpy(), n_stations),
+                    **self._weather_values(value_cols, len(hours) * n_stations),
+                    "latitude": np.tile(self.df_stations["latitude"].to_numpy(), len(hours)),
+                    "longitude": np.tile(self.df_stations["longitude"].to_numpy(), len(hours)),
+                }
+            )
+            .with_columns(
+                (
+                    ((pl.col("datetime") + pl.duration(hours=13)).dt.date() - pl.lit(self.start.date())).dt.days() + 1
+                ).alias("data_block_id")
+            )
+            .select(HISTORICAL_WEATHER_COLS)
+        )
+
+    def weather_station_to_county_mapping(self) -> pl.DataFrame:
+        return self.df_stations.select(
+            pl.when(pl.col("county").is_null())
+            .then(None)
+            .otherwise(pl.lit("county_") + pl.col("county").cast(pl.Utf8))
+            .alias("county_name"),
+            "longitude",
+            "latitude",
+            "county",
+        )
+
+    def tables(self) -> dict[str, pl.DataFrame]:
+        return {
+            "train": self.train(),
+            "client": self.client(),
+            "gas_prices": self.gas_prices(),
+            "electricity_prices": self.electricity_prices(),
+            "forecast_weather": self.forecast_weather(),
+            "historical_weather": self.historical_weather(),
+            "weather_station_to_county_mapping": self.weather_station_to_county_mapping(),
+        }
+
+
+def _last_block(tables: dict[str, pl.DataFrame]) -> int:
+    return tables["train"]["data_block_id"].max()
+
+
+def write_tables(tables: dict[str, pl.DataFrame], root: Path | str, holdout_days: int = 0) -> None:
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    last_block = _last_block(tables)
+    for name, df in tables.items():
+        if "data_block_id" in df.columns:
+            df = df.filter(pl.col("data_block_id") <= last_block - holdout_days)
+        df.write_csv(root / f"{name}.csv")
+
+
+class LocalEnv:
+    def __init__(self, tables: dict[str, pl.DataFrame], holdout_days: int):
+        last_block = _last_block(tables)
+        self.tables = tables
+        self.data_block_ids = list(range(last_block - holdout_days + 1, last_block + 1))
+        self.predictions: list[pd.DataFrame] = []
+        self._expecting_prediction = False
+
+    def _block(self, name: str, data_block_id: int) -> pd.DataFrame:
+        return self.tables[name].filter(pl.col("data_block_id") == data_block_id).to_pandas()
+
+    def iter_test(self) -> Iterator[tuple[pd.DataFrame, ...]]:
+        for data_block_id in self.data_block_ids:
+            if self._expecting_prediction:
+                raise RuntimeError("env.predict must be called before requesting the next batch")
+
+            df_test = (
+                self.tables["train"]
+                .filter(pl.col("data_block_id") == data_block_id)
+                .drop("target")
+                .rename({"datetime": "prediction_datetime"})
+                .select(
+                    "county",
+                    "is_business",
+                    "product_type",
+                    "is_consumption",
+                    "prediction_datetime",
+                    "data_block_id",
+                    "row_id",
+                    "prediction_unit_id",
+                )
+            )
+            df_revealed_targets = self.tables["train"].filter(pl.col("data_block_id") == data_block_id - 2)
+            df_sample_prediction = df_test.select("row_id", "data_block_id", pl.lit(0.0).alias("target"))
+
+            self._expecting_prediction = True
+            yield (
+                df_test.to_pandas(),
+                df_revealed_targets.to_pandas(),
+                self._block("client", data_block_id),
+                self._block("historical_weather", data_block_id),
+                self._block("forecast_weather", data_block_id),
+                self._block("electricity_prices", data_block_id),
+                self._block("gas_prices", data_block_id),
+                df_sample_prediction.to_pandas(),
+            )
+
+    def predict(self, df_prediction: pd.DataFrame) -> None:
+        if not self._expecting_prediction:
+            raise RuntimeError("env.predict called without a pending batch")
+        self.predictions.append(df_prediction.copy())
+        self._expecting_prediction = False
@@ -10,8 +10,9 @@ from omegaconf import DictConfig
 from sklearn.ensemble import VotingRegressor
 
 from data import DataStorage
+from feature_store import load_training_features
 from features import FeatureEngineer
-from modeling import fit_model
+from modeling import fit_model, fit_shared_model
 
 
 @hydra.main(config_path="../config/", config_name="train")
@@ -20,33 +21,49 @@ def _main(cfg: DictConfig):
         warnings.filterwarnings("ignore", category=UserWarning)
         data_storage = DataStorage(cfg)
         feat_gen = FeatureEngineer(data_storage=data_storage)
-        df_train = feat_gen.generate_features(data_storage.df_data)
-        df_train = df_train[df_train["target"].notnull()]
+        df_train = load_training_features(cfg, feat_gen)
+
+        if cfg.models.feature_output == "matrix":
+            if not cfg.models.shared_dataset:
+                raise ValueError("feature_output=matrix requires shared_dataset=true")
+            feat_gen.category_encoder.fit(df_train)
+            feat_gen.category_encoder.save(Path(cfg.models.path) / f"{cfg.models.categories}")
+        df_train = feat_gen.to_output(df_train, output=cfg.models.feature_output)
 
         # Train model
-        model_consumption = VotingRegressor(
-            [
-                (
-                    f"clgb_{i}",
-                    lgb.LGBMRegressor(**cfg.models.params, random_state=i),
-                )
-                for i in range(12)
-            ],
-            verbose=True,
-        )
-
-        model_production = VotingRegressor(
-            [
-                (
-                    f"plgb_{i}",
-                    lgb.LGBMRegressor(**cfg.models.params, random_state=i),
-                )
-                for i in range(12)
-            ],
-            verbose=True,
-        )
-
-        model_consumption, model_production = fit_model(df_train, model_consumption, model_production)
+        if cfg.models.shared_dataset:
+            model_consumption, model_production = fit_shared_model(
+                df_train,
+                params=dict(cfg.models.params),
+                seeds=list(range(cfg.models.n_seeds)),
+                dataset_path=Path(cfg.models.dataset_path) if cfg.models.dataset_path else None,
+                n_workers=cfg.models.n_workers,
+                n_cores=cfg.models.n_cores,
+            )
+        else:
+            model_consumption = VotingRegressor(
+                [
+                    (
+                        f"clgb_{i}",
+                        lgb.LGBMRegressor(**cfg.models.params, random_state=i),
+                    )
+                    for i in range(cfg.models.n_seeds)
+                ],
+                verbose=True,
+            )
+
+            model_production = VotingRegressor(
+                [
+                    (
+                        f"plgb_{i}",
+                        lgb.LGBMRegressor(**cfg.models.params, random_state=i),
+                    )
+                    for i in range(cfg.models.n_seeds)
+                ],
+                verbose=True,
+            )
+
+            model_consumption, model_production = fit_model(df_train, model_consumption, model_production)
 
         joblib.dump(model_consumption, Path(cfg.models.path) / f"{cfg.models.model_consumption_diff}")
         joblib.dump(model_production, Path(cfg.models.path) / f"{cfg.models.model_production_diff}")
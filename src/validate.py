@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import hydra
+import lightgbm as lgb
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig
+
+from data import DataStorage
+from feature_store import load_training_features
+from features import FeatureEngineer, FeatureMatrix
+from modeling import load_dataset, save_dataset, split_target
+
+SEGMENT_COLS = ["county", "is_business", "product_type", "is_consumption"]
+
+
+def _load_features(cfg: DictConfig) -> tuple[FeatureMatrix, pl.DataFrame]:
+    data_storage = DataStorage(cfg)
+    feat_gen = FeatureEngineer(data_storage=data_storage)
+
+    df_features = load_training_features(cfg, feat_gen)
+    feat_gen.category_encoder.fit(df_features)
+    matrix = feat_gen.to_output(df_features, output="matrix")
+
+    df_rows = pl.DataFrame({"row_id": matrix.row_id}).join(
+        data_storage.df_data.select("row_id", "datetime", *SEGMENT_COLS), on="row_id", how="left"
+    )
+    return matrix, df_rows
+
+
+def make_folds(
+    datetimes: pl.Series, n_folds: int, valid_days: int, gap_days: int
+) -> list[tuple[datetime, np.ndarray, np.ndarray]]:
+    last_day = datetimes.max().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+    folds = []
+    for fold in reversed(range(n_folds)):
+        valid_end = last_day - timedelta(days=fold * valid_days)
+        valid_start = valid_end - timedelta(days=valid_days)
+        train_end = valid_start - timedelta(days=gap_days)
+        train_mask = (datetimes < train_end).to_numpy()
+        valid_mask = ((datetimes >= valid_start) & (datetimes < valid_end)).to_numpy()
+        folds.append((valid_start, train_mask, valid_mask))
+
+    return folds
+
+
+def _train_fold(
+    binary_path: Path,
+    params: dict,
+    train_index: np.ndarray,
+    valid_index: np.ndarray,
+    num_boost_round: int,
+    early_stopping_rounds: int,
+    verbose_eval: int,
+    n_jobs: int,
+) -> tuple[str, int]:
+    params = {key: value for key, value in params.items() if key != "n_estimators"}
+    params = {**params, "num_threads": n_jobs, "verbose": -1}
+
+    dataset = load_dataset(binary_path, params)
+    booster = lgb.train(
+        params,
+        dataset.subset(train_index),
+        num_boost_round=num_boost_round,
+        valid_sets=[dataset.subset(valid_index)],
+        valid_names=["valid"],
+        callbacks=[
+            lgb.early_stopping(early_stopping_rounds, verbose=False),
+            lgb.log_evaluation(verbose_eval),
+        ],
+    )
+    return booster.model_to_string(), booster.best_iteration
+
+
+def _segment_mae(df_valid: pl.DataFrame) -> pl.DataFrame:
+    return (
+        df_valid.group_by(SEGMENT_COLS)
+        .agg(
+            pl.col("fold").n_unique().alias("n_folds"),
+            pl.count().alias("n_rows"),
+            (pl.col("prediction") - pl.col("target")).abs().mean().alias("mae"),
+            pl.col("target").mean().alias("mean_target"),
+        )
+        .sort(SEGMENT_COLS)
+    )
+
+
+@hydra.main(config_path="../config/", config_name="validate")
+def _main(cfg: DictConfig):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        matrix, df_rows = _load_features(cfg)
+        folds = make_folds(df_rows["datetime"], cfg.cv.n_folds, cfg.cv.valid_days, cfg.cv.gap_days)
+
+        dataset_path = Path(cfg.models.dataset_path) if cfg.models.dataset_path else None
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            params = {**cfg.models.params, "seed": cfg.cv.seed}
+            branches = {}
+            for is_consumption in [1, 0]:
+                mask = (df_rows["is_consumption"] == is_consumption).to_numpy()
+                X, y = split_target(matrix, is_consumption)
+                binary_path = save_dataset(X, y, params, dataset_path or Path(tmp_dir))
+                branches[is_consumption] = (mask, X, binary_path)
+
+            jobs = []
+            for fold, (_, train_mask, valid_mask) in enumerate(folds):
+                for is_consumption, (mask, _, binary_path) in branches.items():
+                    train_index = np.flatnonzero(train_mask[mask])
+                    valid_index = np.flatnonzero(valid_mask[mask])
+                    if len(train_index) and len(valid_index):
+                        jobs.append((fold, is_consumption, binary_path, train_index, valid_index))
+
+            n_workers = max(1, min(cfg.cv.n_workers, len(jobs)))
+            n_jobs = max(1, (cfg.cv.n_cores or os.cpu_count()) // n_workers)
+            train_args = (cfg.models.num_boost_round, cfg.models.early_stopping_rounds, cfg.models.verbose_eval, n_jobs)
+            with ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                futures = [
+                    executor.submit(_train_fold, binary_path, params, train_index, valid_index, *train_args)
+                    for _, _, binary_path, train_index, valid_index in jobs
+                ]
+
+                results, df_valid = [], []
+                for (fold, is_consumption, _, train_index, valid_index), future in zip(jobs, futures):
+                    model_str, best_iteration = future.result()
+                    mask, X, _ = branches[is_consumption]
+                    target_48h = np.nan_to_num(X.column("target_48h")[valid_index])
+
+                    booster = lgb.Booster(model_str=model_str)
+                    prediction = booster.predict(X.X[valid_index], num_iteration=best_iteration) + target_48h
+                    prediction = np.clip(prediction, 0, np.inf)
+                    target = X.y[valid_index]
+
+                    results.append(
+                        {
+                            "fold": fold,
+                            "is_consumption": is_consumption,
+                            "train_rows": len(train_index),
+                            "valid_rows": len(valid_index),
+                            "valid_start": folds[fold][0].strftime("%Y-%m-%d"),
+                            "best_iteration": best_iteration,
+                            "mae": float(np.abs(prediction - target).mean()),
+                        }
+                    )
+                    df_valid.append(
+                        df_rows.filter(pl.Series(mask))
+                        .select(SEGMENT_COLS)[valid_index]
+                        .with_columns(
+                            pl.lit(fold).alias("fold"),
+                            pl.Series("prediction", prediction),
+                            pl.Series("target", target),
+                        )
+                    )
+
+        df_valid = pl.concat(df_valid)
+        df_segments = _segment_mae(df_valid)
+
+        path = Path(cfg.cv.path)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "folds.json").write_text(json.dumps(results, indent=2))
+        df_segments.write_csv(path / "segments.csv")
+
+        print(f"{'fold':<6}{'branch':<14}{'valid_start':<22}{'train':>10}{'valid':>10}{'best_iter':>11}{'mae':>10}")
+        for result in results:
+            branch = "consumption" if result["is_consumption"] else "production"
+            print(
+                f"{result['fold']:<6}{branch:<14}{result['valid_start']:<22}{result['train_rows']:>10}"
+                f"{result['valid_rows']:>10}{result['best_iteration']:>11}{result['mae']:>10.3f}"
+            )
+        for fold, df_fold in sorted(df_valid.partition_by("fold", as_dict=True).items()):
+            print(f"fold {fold} mae {(df_fold['prediction'] - df_fold['target']).abs().mean():.3f}")
+        print(f"overall mae {(df_valid['prediction'] - df_valid['target']).abs().mean():.3f}")
+        with pl.Config(tbl_rows=cfg.cv.n_worst):
+            print(f"worst segments:\n{df_segments.sort('mae', descending=True).head(cfg.cv.n_worst)}")
+
+
+if __name__ == "__main__":
+    _main()
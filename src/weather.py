@@ -0,0 +1,92 @@
+import numpy as np
+import polars as pl
+from scipy import sparse
+
+
+class WeatherGrid:
+    def __init__(self, df_weather_station_to_county_mapping: pl.DataFrame):
+        df_mapping = df_weather_station_to_county_mapping.with_columns(self._station_key())
+        self.county_dtype = df_mapping.schema["county"]
+        self.df_stations = df_mapping.select("station_key").unique(maintain_order=True).with_row_count("station_id")
+        self.df_station_counties = (
+            df_mapping.filter(pl.col("county").is_not_null())
+            .join(self.df_stations, on="station_key")
+            .select("station_id", "county")
+            .unique()
+        )
+        self.counties = self.df_station_counties["county"].unique().sort()
+        self._build_county_matrix()
+
+    @staticmethod
+    def _station_key() -> pl.Expr:
+        latitude = (pl.col("latitude").cast(pl.Float32) * 100).round(0).cast(pl.Int64)
+        longitude = (pl.col("longitude").cast(pl.Float32) * 100).round(0).cast(pl.Int64)
+        return (latitude * 100_000 + longitude).alias("station_key")
+
+    def _build_county_matrix(self) -> None:
+        county_index = self.df_station_counties.join(
+            pl.DataFrame({"county": self.counties}).with_row_count("county_index"), on="county"
+        )
+        self.county_matrix = sparse.csr_matrix(
+            (
+                np.ones(county_index.height),
+                (county_index["county_index"].to_numpy(), county_index["station_id"].to_numpy()),
+            ),
+            shape=(len(self.counties), self.df_stations.height),
+        )
+
+    def _register_stations(self, station_keys: pl.Series) -> None:
+        df_new = pl.DataFrame({"station_key": station_keys}).join(self.df_stations, on="station_key", how="anti")
+        if df_new.is_empty():
+            return
+
+        self.df_stations = pl.concat(
+            [
+                self.df_stations,
+                df_new.with_row_count("station_id", offset=self.df_stations.height).select(self.df_stations.columns),
+            ]
+        )
+        self._build_county_matrix()
+
+    def aggregate(self, df_weather: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame]:
+        value_cols = [col for col in df_weather.columns if col not in ["datetime", "latitude", "longitude"]]
+
+        df_weather = df_weather.with_columns(self._station_key())
+        self._register_stations(df_weather["station_key"].unique())
+
+        df_index = df_weather.select(
+            (pl.col("datetime").rank("dense").cast(pl.Int64) - 1).alias("time_index"), "station_key"
+        ).join(self.df_stations, on="station_key", how="left")
+        datetimes = df_weather["datetime"].unique().sort()
+
+        n_times, n_stations = len(datetimes), self.df_stations.height
+        flat_index = df_index["time_index"].to_numpy() * n_stations + df_index["station_id"].to_numpy()
+        n_rows = np.bincount(flat_index, minlength=n_times * n_stations).reshape(n_times, n_stations)
+
+        county_index, time_index = np.nonzero(self.county_matrix @ n_rows.T)
+
+        date_values, local_values = {}, {}
+        for col in value_cols:
+            values = df_weather[col].cast(pl.Float64).to_numpy()
+            observed = ~np.isnan(values)
+            sums = np.bincount(flat_index, weights=np.where(observed, values, 0), minlength=n_times * n_stations)
+            counts = np.bincount(flat_index, weights=observed, minlength=n_times * n_stations)
+            sums, counts = sums.reshape(n_times, n_stations), counts.reshape(n_times, n_stations)
+
+            date_values[col] = sums.sum(axis=1) / counts.sum(axis=1)
+            local_sums = (self.county_matrix @ sums.T)[county_index, time_index]
+            local_counts = (self.county_matrix @ counts.T)[county_index, time_index]
+            local_values[col] = local_sums / local_counts
+
+        df_weather_date = pl.DataFrame(
+            [datetimes, *[pl.Series(col, values, nan_to_null=True) for col, values in date_values.items()]]
+        )
+        df_weather_local = pl.DataFrame(
+            [
+                pl.Series("county", self.counties.to_numpy()[county_index], dtype=self.county_dtype),
+                datetimes.gather(time_index),
+                *[pl.Series(col, values, nan_to_null=True) for col, values in local_values.items()],
+            ]
+        )
+
+        return df_weather_date, df_weather_local